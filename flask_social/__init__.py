@@ -14,6 +14,7 @@ __version__ = '1.6.2'
 
 from .core import Social
 from .datastore import SQLAlchemyConnectionDatastore, \
-     MongoEngineConnectionDatastore, PeeweeConnectionDatastore
+     MongoEngineConnectionDatastore, PeeweeConnectionDatastore, \
+     SQLiteConnectionDatastore
 from .signals import connection_created, connection_failed, login_failed, \
      connection_removed, login_completed
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.bloom
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social filter of known provider identities
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import cPickle
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+
+from collections import deque
+
+from .signals import connection_created
+
+
+class BloomFilter(object):
+    """A thread safe Bloom filter of byte strings sized for `capacity` items
+    with a false positive rate of `error_rate`. Items can not be removed.
+
+    :param capacity: The expected number of items
+    :param error_rate: The false positive rate at `capacity` items
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(int(round(float(self.size) / capacity *
+                                    math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _indexes(self, item):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Add an item. Returns `True` if the item was not contained."""
+        indexes = self._indexes(item)
+        with self._lock:
+            added = False
+            for index in indexes:
+                mask = 1 << (index & 7)
+                if not self._bits[index >> 3] & mask:
+                    self._bits[index >> 3] |= mask
+                    added = True
+            if added:
+                self.count += 1
+            return added
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(item))
+
+    def __len__(self):
+        """The number of items added, not counting items that were false
+        positives when they were added."""
+        return self.count
+
+    @property
+    def memory_usage(self):
+        """The number of bytes used by the filter's bits."""
+        return len(self._bits)
+
+    @property
+    def estimated_error_rate(self):
+        """The false positive rate at the current number of items."""
+        filled = 1 - math.exp(-float(self.hashes) * self.count / self.size)
+        return filled ** self.hashes
+
+    def __getstate__(self):
+        with self._lock:
+            return dict(size=self.size, hashes=self.hashes, count=self.count,
+                        bits=str(self._bits))
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.hashes = state['hashes']
+        self.count = state['count']
+        self._bits = bytearray(state['bits'])
+        self._lock = threading.Lock()
+
+
+def _identity_key(provider_id, provider_user_id):
+    return (u'%s\0%s' % (provider_id, provider_user_id)).encode('utf-8')
+
+
+class IdentityFilter(object):
+    """A filter of the `(provider_id, provider_user_id)` pairs of all
+    connections, used to reject logins of unknown provider users without
+    querying the datastore. The filter is built by reading all connections
+    or loaded from a snapshot file and is updated when a
+    `connection_created` signal is sent.
+
+    Connections created by other processes are added by reading the
+    connections with a greater primary key than the last ones read, at most
+    once every `refresh_interval` seconds, when a pair is not found. The last
+    `overlap` connections read are read again, so that connections committed
+    out of primary key order, for example by concurrent transactions, are
+    added as long as fewer than `overlap` connections with a greater primary
+    key were committed before them. Removed connections stay in the filter
+    until it is built again and are counted with :meth:`record_removed`.
+
+    Reading only the greater primary keys would miss new connections whose
+    keys are not greater, so a `ValueError` is raised if the datastore's
+    connections do not have auto incrementing integer primary keys, for
+    example MongoEngine's ObjectIds.
+
+    :param datastore: The connection datastore
+    :param capacity: The expected number of connections
+    :param error_rate: The false positive rate at `capacity` connections
+    :param refresh_interval: The smallest number of seconds between reads of
+                             new connections
+    :param snapshot: The path of the snapshot file
+    :param overlap: The number of connections read again by each read of new
+                    connections
+    """
+
+    def __init__(self, datastore, capacity, error_rate=0.01,
+                 refresh_interval=5, snapshot=None, overlap=1000,
+                 timer=time.time):
+        if not datastore._has_sequential_pk():
+            raise ValueError('The identity filter requires connections with '
+                             'sequential primary keys')
+        self.datastore = datastore
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.snapshot = snapshot
+        self.overlap = overlap
+        self.checks = 0
+        self.rejected = 0
+        self.removed = 0
+        self._filter = None
+        # The primary key reads of new connections start after, followed by
+        # the primary keys of the last `overlap` connections read
+        self._recent = [None]
+        self._refreshed_at = 0
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        connection_created.connect(self._on_connection_created)
+
+    @property
+    def ready(self):
+        """`True` once the filter has been built or loaded. Every pair might
+        exist until then."""
+        return self._filter is not None
+
+    def _read(self, bloom, after):
+        datastore = self.datastore
+        fields = ('provider_id', 'provider_user_id')
+        recent = deque([after], self.overlap + 1)
+        while True:
+            chunk = list(datastore._find_connections_chunk(
+                after, datastore.chunk_size, fields=fields))
+            for connection in chunk:
+                bloom.add(_identity_key(connection.provider_id,
+                                        connection.provider_user_id))
+                recent.append(datastore._get_pk(connection))
+            if chunk:
+                after = recent[-1]
+            if len(chunk) < datastore.chunk_size:
+                return list(recent)
+
+    def build(self):
+        """Build the filter from all connections. Must be called within an
+        application context."""
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        refreshed_at = self._timer()
+        recent = self._read(bloom, None)
+        with self._refresh_lock:
+            self._filter = bloom
+            self._recent = recent
+            self._refreshed_at = refreshed_at
+            self.removed = 0
+
+    def refresh(self):
+        """Add the connections created since the filter was built or last
+        refreshed. Must be called within an application context."""
+        self._refresh(0)
+
+    def _refresh(self, interval):
+        with self._refresh_lock:
+            # Concurrent misses waiting for the lock do not read again
+            now = self._timer()
+            if self._filter is None or now - self._refreshed_at < interval:
+                return
+            self._refreshed_at = now
+            self._recent = self._read(self._filter, self._recent[0])
+
+    def load(self, path=None):
+        """Load the filter from a snapshot file and add the connections
+        created since it was saved. Must be called within an application
+        context.
+
+        :param path: The snapshot file, defaults to `snapshot`
+        """
+        with open(path or self.snapshot, 'rb') as f:
+            data = cPickle.load(f)
+        with self._refresh_lock:
+            self._filter = data['filter']
+            self._recent = data['recent']
+        self.refresh()
+
+    def save(self, path=None):
+        """Save the filter to a snapshot file.
+
+        :param path: The snapshot file, defaults to `snapshot`
+        """
+        path = path or self.snapshot
+        with self._refresh_lock:
+            data = dict(filter=self._filter, recent=self._recent)
+        if data['filter'] is None:
+            return
+        # Written to a temporary file first so that a process loading the
+        # snapshot never reads a partial file
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    def start(self):
+        """Load the filter from the snapshot file if it exists, otherwise
+        build it and save the snapshot. Must be called within an application
+        context."""
+        if self.snapshot and os.path.exists(self.snapshot):
+            self.load()
+            return
+        self.build()
+        if self.snapshot:
+            self.save()
+
+    def add(self, provider_id, provider_user_id):
+        """Add a connection's provider identity."""
+        bloom = self._filter
+        if bloom is not None:
+            bloom.add(_identity_key(provider_id, provider_user_id))
+
+    def record_removed(self, count=1):
+        """Count removed connections, which stay in the filter until it is
+        built again."""
+        with self._lock:
+            self.removed += count
+
+    def might_exist(self, provider_id, provider_user_id):
+        """Return `False` if no connection exists for the specified provider
+        user. Must be called within an application context.
+
+        :param provider_id: The provider ID
+        :param provider_user_id: The provider user ID
+        """
+        bloom = self._filter
+        if bloom is None:
+            return True
+        key = _identity_key(provider_id, provider_user_id)
+        with self._lock:
+            self.checks += 1
+        if key in bloom:
+            return True
+        if self._timer() - self._refreshed_at >= self.refresh_interval:
+            self._refresh(self.refresh_interval)
+            if key in bloom:
+                return True
+        with self._lock:
+            self.rejected += 1
+        return False
+
+    def stats(self):
+        """Return the filter's size, memory use and counters."""
+        bloom = self._filter
+        stats = dict(ready=bloom is not None, capacity=self.capacity,
+                     error_rate=self.error_rate, checks=self.checks,
+                     rejected=self.rejected, removed=self.removed)
+        if bloom is not None:
+            stats.update(items=len(bloom), bits=bloom.size,
+                         hashes=bloom.hashes, bytes=bloom.memory_usage,
+                         estimated_error_rate=bloom.estimated_error_rate)
+        return stats
+
+    def _is_current(self, app):
+        state = app.extensions.get('social')
+        return state is not None and state.identity_filter is self
+
+    def _on_connection_created(self, app, connection=None, **kwargs):
+        if connection is not None and self._is_current(app):
+            self.add(connection.provider_id, connection.provider_user_id)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.cache
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social in-process caches
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import cPickle
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class KeyValueCache(object):
+    """The interface of a cache storing byte strings by string keys, such as
+    a memcached or Redis client adapter, used by
+    :class:`~flask_social.datastore.CachingConnectionDatastore`.
+    """
+
+    def get(self, key):
+        """Return the value of a key or `None`."""
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        """Set the value of a key, kept for `timeout` seconds or the cache's
+        default time if `timeout` is `None`."""
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """Set the value of a key unless it has a value. Returns `True` if the
+        value was set."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove a key."""
+        raise NotImplementedError
+
+
+class PickleSerializer(object):
+    """Serializes values with the highest pickle protocol."""
+
+    def dumps(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class LRUCache(KeyValueCache):
+    """A thread safe cache holding at most `maxsize` items. The least recently
+    used item is evicted when the cache is full and items expire `ttl`
+    seconds after they were stored.
+
+    :param maxsize: The maximum number of items. A size of `0` disables the
+                    cache.
+    :param ttl: The number of seconds an item is kept. `None` keeps items
+                until they are evicted.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._timer = timer
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self._timer():
+                self.misses += 1
+                return default
+            self._items[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def _store(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else self._timer() + ttl
+        self._items.pop(key, None)
+        self._items[key] = (value, expires)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key, value, timeout=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._store(key, value, timeout)
+
+    def add(self, key, value):
+        if self.maxsize <= 0:
+            return True
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (item[1] is None or
+                                     item[1] > self._timer()):
+                return False
+            self._store(key, value)
+            return True
+
+    def delete(self, key):
+        self.pop(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._items.pop(key)[0]
+            except KeyError:
+                return default
+
+    def discard_if(self, predicate):
+        """Remove every item whose key matches `predicate` and return the
+        number of items removed."""
+        with self._lock:
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                del self._items[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self),
+                    maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.circuit
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social provider circuit breaker
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+
+
+class ProviderUnavailable(Exception):
+    """Raised when a provider did not respond in time or failed, or when its
+    circuit breaker is open and the provider is not called at all.
+
+    :param provider_id: The provider ID
+    :param reason: A description of the failure
+    """
+
+    def __init__(self, provider_id, reason):
+        Exception.__init__(self, '%s is unavailable: %s' % (provider_id,
+                                                            reason))
+        self.provider_id = provider_id
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    """A thread safe circuit breaker. The circuit opens after `threshold`
+    consecutive failures and calls are then refused for `reset_timeout`
+    seconds. After that a single trial call is allowed; the circuit closes if
+    it succeeds and opens again if it fails.
+
+    :param threshold: The number of consecutive failures opening the circuit
+    :param reset_timeout: The number of seconds the circuit stays open
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, timer=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._timer = timer
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """`closed`, `open` or `half-open`."""
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._timer() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def allow(self):
+        """Return `True` if a call may be made. Only one trial call is allowed
+        while the circuit is half-open."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._timer() - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self._opened_at = self._timer()
+            self._trial = False
+
+    def retry_after(self):
+        """Return the number of seconds until the circuit allows a trial
+        call."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(self._opened_at + self.reset_timeout - self._timer(), 0)
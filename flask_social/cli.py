@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.cli
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social command line interface. It is
+    registered with the application's ``flask`` command on Flask 0.11 and
+    later.
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import click
+
+from flask import current_app
+from flask.cli import AppGroup
+
+from .bloom import IdentityFilter
+from .refresh import refresh_profiles, refresh_tokens
+
+social = AppGroup('social', help='Flask-Social maintenance commands.')
+
+
+@social.command('refresh-profiles')
+@click.option('--provider', 'provider_ids', multiple=True,
+              help='Provider to refresh, may be repeated. Defaults to all '
+                   'providers with a bulk profile endpoint.')
+@click.option('--concurrency', default=4, show_default=True,
+              help='Number of concurrent provider requests.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of changed connections per commit.')
+def refresh_profiles_command(provider_ids, concurrency, batch_size):
+    """Refresh the stored profile values of all connections."""
+    stats = refresh_profiles(provider_ids=provider_ids or None,
+                             concurrency=concurrency, batch_size=batch_size)
+    for provider_id, counters in sorted(stats.items()):
+        click.echo('%s: %d checked, %d updated, %d failed' % (
+            provider_id, counters['checked'], counters['updated'],
+            counters['failed']))
+
+
+@social.command('refresh-tokens')
+@click.option('--provider', 'provider_ids', multiple=True,
+              help='Provider to refresh, may be repeated. Defaults to all '
+                   'OAuth 2 providers.')
+@click.option('--within', default=3600, show_default=True,
+              help='Refresh tokens expiring within this many seconds.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of refreshed connections per commit.')
+def refresh_tokens_command(provider_ids, within, batch_size):
+    """Refresh the access tokens that are about to expire."""
+    stats = refresh_tokens(provider_ids=provider_ids or None, within=within,
+                           batch_size=batch_size)
+    for provider_id, counters in sorted(stats.items()):
+        click.echo('%s: %d expiring, %d refreshed, %d failed' % (
+            provider_id, counters['expiring'], counters['refreshed'],
+            counters['failed']))
+
+
+@social.command('save-identity-filter')
+@click.argument('path')
+@click.option('--capacity', type=int,
+              help='Expected number of connections. Defaults to '
+                   'SOCIAL_IDENTITY_FILTER_CAPACITY.')
+@click.option('--error-rate', type=float,
+              help='False positive rate. Defaults to '
+                   'SOCIAL_IDENTITY_FILTER_ERROR_RATE.')
+def save_identity_filter_command(path, capacity, error_rate):
+    """Build the filter of known provider identities and save it."""
+    config = current_app.config
+    identity_filter = IdentityFilter(
+        current_app.extensions['social'].datastore,
+        capacity or config['SOCIAL_IDENTITY_FILTER_CAPACITY'] or 100000,
+        error_rate or config['SOCIAL_IDENTITY_FILTER_ERROR_RATE'],
+        overlap=config['SOCIAL_IDENTITY_FILTER_OVERLAP'])
+    identity_filter.build()
+    identity_filter.save(path)
+    stats = identity_filter.stats()
+    click.echo('%d identities, %d bytes, %.4f estimated false positive '
+               'rate' % (stats['items'], stats['bytes'],
+                         stats['estimated_error_rate']))
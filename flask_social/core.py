@@ -8,15 +8,36 @@
     :copyright: (c) 2012 by Matt Wright.
     :license: MIT, see LICENSE for more details.
 """
+import atexit
+import hashlib
+import httplib
+import threading
+import urlparse
+import warnings
+
+from collections import Mapping
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import wraps
 from importlib import import_module
 
-from flask import current_app
-from flask_oauthlib.client import OAuthRemoteApp as BaseRemoteApp
+from flask import after_this_request, current_app, has_request_context
+from flask_oauthlib.client import OAuthException, \
+     OAuthRemoteApp as BaseRemoteApp, parse_response, prepare_request
 from flask.ext.security import current_user
 from werkzeug.local import LocalProxy
 
-from .utils import get_config, update_recursive
-from .views import create_blueprint
+from .bloom import IdentityFilter
+from .cache import LRUCache
+from .circuit import CircuitBreaker, ProviderUnavailable
+from .providers import ModuleProviderAdapter
+from .ratelimit import RateLimitedAPI, TokenBucket, parse_rate_limit_headers
+from .transport import HTTPError, HTTPTransport, RETRY_STATUSES, \
+     request_policy
+from .utils import get_config, get_current_connection, get_token_values, \
+     token_expires_soon, update_recursive
+from .views import _commit, create_blueprint
+from .writebehind import WriteBehindQueue
 
 _security = LocalProxy(lambda: current_app.extensions['security'])
 
@@ -33,29 +54,257 @@ default_config = {
     'SOCIAL_CONNECT_DENY_VIEW': '/',
     'SOCIAL_POST_OAUTH_CONNECT_SESSION_KEY': 'post_oauth_connect_url',
     'SOCIAL_POST_OAUTH_LOGIN_SESSION_KEY': 'post_oauth_login_url',
-    'SOCIAL_APP_URL': 'http://localhost'
+    'SOCIAL_APP_URL': 'http://localhost',
+    'SOCIAL_API_CACHE_SIZE': 500,
+    'SOCIAL_API_CACHE_TTL': 300,
+    'SOCIAL_HTTP_POOL_SIZE': 10,
+    'SOCIAL_HTTP_TIMEOUT': 10,
+    'SOCIAL_TOKEN_REFRESH_MARGIN': 300,
+    'SOCIAL_WRITE_BEHIND_INTERVAL': None,
+    'SOCIAL_IDENTITY_FILTER_CAPACITY': None,
+    'SOCIAL_IDENTITY_FILTER_ERROR_RATE': 0.01,
+    'SOCIAL_IDENTITY_FILTER_REFRESH': 5,
+    'SOCIAL_IDENTITY_FILTER_SNAPSHOT': None,
+    'SOCIAL_IDENTITY_FILTER_OVERLAP': 1000
 }
 
 
+def _token_fingerprint(connection):
+    token = u'%s\0%s' % (connection.access_token, connection.secret or u'')
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+
 class OAuthRemoteApp(BaseRemoteApp):
 
-    def __init__(self, id, module, install, *args, **kwargs):
+    def __init__(self, id, module, install, rate_limit=None,
+                 rate_limit_timeout=None, timeout=15, retries=1,
+                 circuit_breaker=(5, 30), *args, **kwargs):
         BaseRemoteApp.__init__(self, None, **kwargs)
         self.id = id
         self.module = module
+        self.rate_limiter = TokenBucket(*rate_limit) if rate_limit else None
+        self.rate_limit_timeout = rate_limit_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.circuit_breaker = (CircuitBreaker(*circuit_breaker)
+                                if circuit_breaker else None)
+        self._last_response = threading.local()
+        module = import_module(module)
+        adapter_class = getattr(module, 'adapter_class', ModuleProviderAdapter)
+        self.adapter = adapter_class(self, module)
+
+    def http_request(self, uri, headers=None, data=None, method=None):
+        """Send the OAuth token requests through the extension's pooled
+        transport instead of opening a new connection for each request."""
+        uri, headers, data, method = prepare_request(uri, headers, data,
+                                                     method)
+        if data and 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        resp = _social.transport.request(uri, method=method.upper(),
+                                         body=data, headers=headers)
+        self._last_response.status = resp.status
+        return resp, resp.content
+
+    def authorized_handler(self, f):
+        """Like Flask-OAuthlib's, but the exception of a token request the
+        provider failed with a retryable error status is raised instead of
+        being passed to `f`, so that :meth:`protect` counts it as a failure.
+        """
+        @wraps(f)
+        def handler(data, *args, **kwargs):
+            if (isinstance(data, OAuthException) and
+                    self._last_response.status in RETRY_STATUSES):
+                raise data
+            return f(data, *args, **kwargs)
+        return BaseRemoteApp.authorized_handler(self, handler)
+
+    @contextmanager
+    def protect(self):
+        """Apply the provider's `timeout` deadline and `retries` to the
+        requests sent to the provider within the block and record the outcome
+        with the provider's circuit breaker. Raises
+        :class:`~flask_social.circuit.ProviderUnavailable` without entering
+        the block while the circuit is open, and when a request fails, the
+        token endpoint responds with a retryable error status or the deadline
+        passes.
+        """
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise ProviderUnavailable(self.id, 'circuit open, retry in %d '
+                                      'seconds' % breaker.retry_after())
+        self._last_response.status = None
+        try:
+            with request_policy(self.timeout, self.retries):
+                yield
+        except Exception as e:
+            if isinstance(e, (IOError, httplib.HTTPException)):
+                retryable = True
+            elif isinstance(e, HTTPError):
+                retryable = e.response.status in RETRY_STATUSES
+            else:
+                # Flask-OAuthlib raises OAuthException, or fails to parse the
+                # error page, when a token request gets an error status
+                retryable = self._last_response.status in RETRY_STATUSES
+            if not retryable:
+                if breaker is not None:
+                    breaker.record_success()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            raise ProviderUnavailable(self.id, e)
+        if breaker is not None:
+            breaker.record_success()
 
     def get_connection(self):
-        return _social.datastore.find_connection(provider_id=self.id,
-                                                 user_id=current_user.id)
-
-    def get_api(self):
-        module = import_module(self.module)
+        return get_current_connection(self.id)
+
+    def get_api(self, rate_limit_timeout=False):
+        """Return an API client configured for the current user's connection
+        or `None` if the user is not connected. When the provider has a
+        `rate_limit`, every method call of the client waits for the rate limit
+        and raises :class:`~flask_social.ratelimit.RateLimitExceeded` if it
+        can not be made within `rate_limit_timeout` seconds.
+
+        :param rate_limit_timeout: Overrides the provider's
+                                   `rate_limit_timeout`. `None` waits as long
+                                   as necessary and `0` fails fast.
+        """
         connection = self.get_connection()
         if connection is None:
             return None
-        return module.get_api(connection=connection,
-                              consumer_key=self.consumer_key,
-                              consumer_secret=self.consumer_secret)
+        margin = _social.token_refresh_margin
+        if (token_expires_soon(connection, margin) and
+                self.refresh_access_token(connection)):
+            # Within a request the refreshed token is committed with the rest
+            # of the request's changes
+            if has_request_context():
+                after_this_request(_commit)
+            else:
+                _datastore.commit()
+        key = (self.id, current_user.get_id(), _token_fingerprint(connection))
+        api = _social.api_cache.get(key)
+        if api is None:
+            if self.rate_limiter is None:
+                api = self.adapter.get_api(connection)
+            else:
+                api = self.adapter.get_api(
+                    connection, response_hook=self.update_rate_limit)
+            _social.api_cache.set(key, api)
+        if self.rate_limiter is None:
+            return api
+        if rate_limit_timeout is False:
+            rate_limit_timeout = self.rate_limit_timeout
+        return RateLimitedAPI(api, self.id, self.rate_limiter,
+                              rate_limit_timeout)
+
+    def update_rate_limit(self, response):
+        """Adjust the provider's rate limit to the quota reported in the
+        headers of a provider response.
+
+        :param response: A :class:`~flask_social.transport.HTTPResponse`
+        """
+        quota = parse_rate_limit_headers(response.headers,
+                                         self.rate_limiter.calls)
+        if quota is not None:
+            self.rate_limiter.update(*quota)
+
+    def refresh_access_token(self, connection):
+        """Exchange the refresh token of the specified connection for a new
+        access token and store it on the connection. Returns `False` if the
+        connection has no refresh token or the provider refused it. The
+        connection is added to the datastore but not committed.
+
+        :param connection: The connection to refresh
+        """
+        refresh_token = getattr(connection, 'refresh_token', None)
+        if not refresh_token or self.request_token_url:
+            return False
+
+        body = self.make_client().prepare_refresh_body(
+            refresh_token=refresh_token, client_id=self.consumer_key,
+            client_secret=self.consumer_secret)
+        try:
+            resp, content = self.http_request(
+                self.expand_url(self.access_token_url),
+                data=body.encode(self.encoding), method='POST')
+            data = parse_response(resp, content,
+                                  content_type=self.content_type)
+        except (IOError, ValueError, httplib.HTTPException) as e:
+            _logger.warning('Failed to refresh %s token: %s' % (self.name, e))
+            return False
+        if resp.code not in (200, 201) or not data.get('access_token'):
+            _logger.warning('%s refused to refresh a token: %s' %
+                            (self.name, content))
+            return False
+
+        values = get_token_values(data)
+        connection.access_token = data['access_token']
+        connection.refresh_token = values['refresh_token'] or refresh_token
+        connection.expires_at = values['expires_at']
+        _datastore.put(connection)
+        # The user id as returned by the user's get_id, without loading the
+        # user
+        self.invalidate_api(unicode(_datastore._get_user_id(connection)))
+        return True
+
+    def invalidate_api(self, user_id):
+        """Remove the cached API clients of the specified user, for example
+        after the user's token has changed."""
+        key = (self.id, user_id)
+        return _social.api_cache.discard_if(lambda k: k[:2] == key)
+
+
+def _load_provider(module_name, config, transport=None):
+    module = import_module(module_name)
+    config = update_recursive(deepcopy(module.config), config)
+    provider = OAuthRemoteApp(**config)
+    provider.tokengetter(_get_token)
+    if provider.rate_limiter is not None and transport is not None:
+        host = urlparse.urlsplit(provider.base_url).hostname
+        transport.observe(host, provider.update_rate_limit)
+    return provider
+
+
+class _ProviderRegistry(Mapping):
+    """A mapping of provider IDs to :class:`OAuthRemoteApp` instances. Only
+    the module path and configuration of each provider are stored when the
+    application is initialized. The provider module, and thus the provider's
+    API library, is imported the first time the provider is accessed.
+
+    :param transport: The :class:`~flask_social.transport.HTTPTransport`
+                      whose responses adjust the providers' rate limits
+    """
+
+    def __init__(self, transport=None):
+        self.transport = transport
+        self._specs = {}
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def register(self, provider_id, module_name, config):
+        self._specs[provider_id] = (module_name, config)
+        self._providers.pop(provider_id, None)
+
+    def is_loaded(self, provider_id):
+        return provider_id in self._providers
+
+    def __getitem__(self, provider_id):
+        try:
+            return self._providers[provider_id]
+        except KeyError:
+            module_name, config = self._specs[provider_id]
+
+        with self._lock:
+            if provider_id not in self._providers:
+                self._providers[provider_id] = _load_provider(
+                    module_name, config, self.transport)
+        return self._providers[provider_id]
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
 
 
 def _get_state(app, datastore, providers, **kwargs):
@@ -81,6 +330,16 @@ class _SocialState(object):
         for key, value in kwargs.items():
             setattr(self, key.lower(), value)
 
+    @property
+    def rate_limits(self):
+        """The current quota of each loaded provider with a rate limit."""
+        limiters = [(provider_id, self.providers[provider_id].rate_limiter)
+                    for provider_id in self.providers
+                    if self.providers.is_loaded(provider_id)]
+        return dict((provider_id, limiter.quota())
+                    for provider_id, limiter in limiters
+                    if limiter is not None)
+
     def __getattr__(self, name):
         try:
             return self.providers[name]
@@ -114,10 +373,24 @@ class Social(object):
 
         datastore = datastore or self.datastore
 
+        if hasattr(datastore, 'init_app'):
+            datastore.init_app(app)
+
+        # The datastore may be omitted or be a custom one that does not
+        # report its indexes
+        missing_indexes = getattr(datastore, 'missing_indexes', None)
+        for lookup in missing_indexes() if missing_indexes else ():
+            warnings.warn('%s has no index for looking up connections by %s. '
+                          'Every such lookup will scan all connections.' %
+                          (datastore.connection_model.__name__,
+                           ' and '.join(lookup)), stacklevel=2)
+
         for key, value in default_config.items():
             app.config.setdefault(key, value)
 
-        providers = dict()
+        transport = HTTPTransport(app.config['SOCIAL_HTTP_POOL_SIZE'],
+                                  app.config['SOCIAL_HTTP_TIMEOUT'])
+        providers = _ProviderRegistry(transport)
 
         for key, config in app.config.items():
             if not key.startswith('SOCIAL_') or config is None or key in default_config:
@@ -126,17 +399,40 @@ class Social(object):
             suffix = key.lower().replace('social_', '')
             default_module_name = 'flask_social.providers.%s' % suffix
             module_name = config.get('module', default_module_name)
-            module = import_module(module_name)
-            config = update_recursive(module.config, config)
-
-            providers[config['id']] = OAuthRemoteApp(**config)
-            providers[config['id']].tokengetter(_get_token)
-
-        state = _get_state(app, datastore, providers)
+            providers.register(config.get('id', suffix), module_name, config)
+
+        api_cache = LRUCache(app.config['SOCIAL_API_CACHE_SIZE'],
+                             app.config['SOCIAL_API_CACHE_TTL'])
+        token_queue = None
+        if app.config['SOCIAL_WRITE_BEHIND_INTERVAL']:
+            token_queue = WriteBehindQueue(
+                datastore, app.config['SOCIAL_WRITE_BEHIND_INTERVAL'])
+            # Started on the first request so that the thread is created in
+            # the worker process of a preforking server
+            app.before_first_request(lambda: token_queue.start(app))
+            atexit.register(token_queue.stop, app)
+        identity_filter = None
+        if app.config['SOCIAL_IDENTITY_FILTER_CAPACITY']:
+            identity_filter = IdentityFilter(
+                datastore, app.config['SOCIAL_IDENTITY_FILTER_CAPACITY'],
+                app.config['SOCIAL_IDENTITY_FILTER_ERROR_RATE'],
+                app.config['SOCIAL_IDENTITY_FILTER_REFRESH'],
+                app.config['SOCIAL_IDENTITY_FILTER_SNAPSHOT'],
+                app.config['SOCIAL_IDENTITY_FILTER_OVERLAP'])
+            app.before_first_request(identity_filter.start)
+            if identity_filter.snapshot:
+                atexit.register(identity_filter.save)
+        state = _get_state(app, datastore, providers, api_cache=api_cache,
+                           transport=transport, token_queue=token_queue,
+                           identity_filter=identity_filter)
 
         app.register_blueprint(create_blueprint(state, __name__))
         app.extensions['social'] = state
 
+        if hasattr(app, 'cli'):
+            from .cli import social
+            app.cli.add_command(social)
+
         return state
 
     def __getattr__(self, name):
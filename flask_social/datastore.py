@@ -9,9 +9,39 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app
 from flask_security.datastore import SQLAlchemyDatastore, MongoEngineDatastore, \
     PeeweeDatastore
 
+from .cache import LRUCache, PickleSerializer
+from .signals import connection_created
+
+#: The field combinations connections are looked up by, most selective
+#: field first
+CONNECTION_LOOKUPS = (('provider_user_id', 'provider_id'),
+                      ('user_id', 'provider_id'))
+
+#: The connection fields read and written when logging in with a provider
+LOGIN_FIELDS = ('user_id', 'provider_id', 'provider_user_id', 'access_token',
+                'secret', 'refresh_token', 'expires_at')
+
+
+def _is_covered(lookup, indexes):
+    """Return `True` if one of the indexes, given as sequences of field
+    names, leads with the lookup's fields or its most selective field."""
+    for fields in indexes:
+        fields = list(fields)
+        if fields and (fields[0] == lookup[0] or
+                       set(fields[:len(lookup)]) == set(lookup)):
+            return True
+    return False
+
 
 class ConnectionDatastore(object):
     """Abstracted oauth connection datastore. Always extend this class and
@@ -22,16 +52,234 @@ class ConnectionDatastore(object):
 
     def __init__(self, connection_model):
         self.connection_model = connection_model
+        self._query_shapes = {}
+
+    def _build_query_shape(self, keys, fields):
+        """Return a function building the query for connections matching
+        values for the specified keys, loading only the specified fields or
+        all fields if `fields` is `None`."""
+        raise NotImplementedError
+
+    def _query(self, fields=None, **kwargs):
+        # Query shapes are built once per combination of keys and fields
+        key = (tuple(sorted(kwargs)), tuple(fields) if fields else None)
+        shape = self._query_shapes.get(key)
+        if shape is None:
+            shape = self._query_shapes[key] = self._build_query_shape(*key)
+        return shape(kwargs)
+
+    def find_connection(self, fields=None, **kwargs):
+        """Return the connection matching the specified values or `None`.
+
+        :param fields: The names of the fields to load, defaults to all fields.
+                       The primary key is always loaded.
+        """
+        raise NotImplementedError
+
+    #: The number of connections loaded per query by :meth:`find_connections`
+    chunk_size = 1000
+
+    def _find_connections_chunk(self, after, limit, fields=None, **kwargs):
+        """Return at most `limit` connections matching the specified values,
+        ordered by primary key and starting after the primary key `after`."""
+        raise NotImplementedError
+
+    def _find_expiring_chunk(self, after, limit, before, **kwargs):
+        """Return at most `limit` connections matching the specified values
+        that have a refresh token and expire at or before `before`, ordered
+        by expiry and primary key and starting after the `(expires_at, pk)`
+        pair `after`."""
+        raise NotImplementedError
+
+    def _get_pk(self, connection):
+        return connection.id
+
+    def _has_sequential_pk(self):
+        """Return `True` if new connections are given greater primary keys
+        than existing connections, as with auto incrementing integers."""
+        return False
+
+    def find_connections(self, fields=None, **kwargs):
+        """Iterate over the connections matching the specified values. The
+        connections are loaded `chunk_size` at a time in primary key order, so
+        memory use does not depend on the number of connections and
+        connections may be changed and committed while iterating.
+
+        :param fields: The names of the fields to load, defaults to all fields.
+                       The primary key is always loaded.
+        """
+        return self._iter_chunks(lambda after: self._find_connections_chunk(
+            after, self.chunk_size, fields=fields, **kwargs))
+
+    def find_expiring_connections(self, before, **kwargs):
+        """Iterate over the connections matching the specified values that
+        have a refresh token and expire at or before `before`, soonest expiry
+        first. The connections are loaded `chunk_size` at a time like
+        :meth:`find_connections`. Nothing is returned if the connection model
+        has no `refresh_token` and `expires_at` fields.
+
+        :param before: A UTC datetime
+        """
+        model = self.connection_model
+        if not (hasattr(model, 'refresh_token') and
+                hasattr(model, 'expires_at')):
+            return iter(())
+        return self._iter_chunks(
+            lambda after: self._find_expiring_chunk(
+                after, self.chunk_size, before, **kwargs),
+            lambda connection: (connection.expires_at,
+                                self._get_pk(connection)))
+
+    def _iter_chunks(self, find_chunk, position=None):
+        position = position or self._get_pk
+        after = None
+        while True:
+            chunk = list(find_chunk(after))
+            if not chunk:
+                return
+            after = position(chunk[-1])
+            for connection in chunk:
+                yield connection
+            if len(chunk) < self.chunk_size:
+                return
 
-    def find_connection(self, **kwargs):
+    def _get_indexes(self, unique=False):
+        """Return the indexed field combinations of the connection model, only
+        those of unique indexes if `unique` is set, or `None` if they can not
+        be determined."""
+        return None
+
+    def missing_indexes(self):
+        """Return the connection lookups that are not covered by an index of
+        the connection model."""
+        indexes = self._get_indexes()
+        if indexes is None:
+            return []
+        return [lookup for lookup in CONNECTION_LOOKUPS
+                if not _is_covered(lookup, indexes)]
+
+    #: The maximum number of user IDs in a single lookup query
+    lookup_chunk_size = 500
+
+    def _find_connections_for_users(self, user_ids, provider_ids):
+        for user_id in user_ids:
+            for connection in self.find_connections(user_id=user_id):
+                if provider_ids is None or \
+                        connection.provider_id in provider_ids:
+                    yield connection
+
+    def _get_user_id(self, connection):
+        return connection.user_id
+
+    def _get_values(self, connection):
+        """Return the loaded field values of a connection, including its
+        primary key."""
         raise NotImplementedError
 
-    def find_connections(self, **kwargs):
+    def _from_values(self, values):
+        """Return a connection with the values returned by :meth:`_get_values`
+        without loading it from the database."""
         raise NotImplementedError
 
+    def find_connections_for_users(self, user_ids, provider_ids=None):
+        """Return the connections of several users, optionally limited to the
+        specified providers, as a dictionary mapping each user ID to a list of
+        connections. The connections are loaded with one query per
+        `lookup_chunk_size` users.
+
+        :param user_ids: The user IDs
+        :param provider_ids: The provider IDs, defaults to all providers
+        """
+        user_ids = list(user_ids)
+        keys = dict((unicode(user_id), user_id) for user_id in user_ids)
+        rv = dict((user_id, []) for user_id in user_ids)
+        if provider_ids is not None:
+            provider_ids = list(provider_ids)
+        size = self.lookup_chunk_size
+        for i in range(0, len(user_ids), size):
+            chunk = user_ids[i:i + size]
+            for connection in self._find_connections_for_users(chunk,
+                                                               provider_ids):
+                user_id = keys[unicode(self._get_user_id(connection))]
+                rv[user_id].append(connection)
+        return rv
+
     def create_connection(self, **kwargs):
         return self.put(self.connection_model(**kwargs))
 
+    def _get_login_fields(self):
+        return tuple(name for name in LOGIN_FIELDS
+                     if name == 'user_id' or
+                     hasattr(self.connection_model, name))
+
+    def login_lookup(self, provider_id, provider_user_id):
+        """Return the connection to a provider user, loading only the fields
+        used when logging in, and the connection's user. Returns `None` twice
+        if there is no such connection."""
+        connection = self.find_connection(fields=self._get_login_fields(),
+                                          provider_id=provider_id,
+                                          provider_user_id=provider_user_id)
+        if connection is None:
+            return None, None
+        return connection, connection.user
+
+    def _update_values(self, pk, values):
+        """Set the specified fields of the connection with the primary key
+        `pk` with a single statement."""
+        raise NotImplementedError
+
+    def _set_loaded_values(self, connection, values):
+        """Set values on a connection without marking them to be written."""
+        for key, value in values.items():
+            setattr(connection, key, value)
+
+    def _update_connection(self, connection, values):
+        self._update_values(self._get_pk(connection), values)
+        self._set_loaded_values(connection, values)
+
+    def update_connection(self, connection, **values):
+        """Write the specified values of a connection that differ from the
+        values it was loaded with, updating only those fields with a single
+        statement. Returns `True` if any value changed."""
+        changed = dict((key, value) for key, value in values.items()
+                       if getattr(connection, key) != value)
+        if not changed:
+            return False
+        self._update_connection(connection, changed)
+        return True
+
+    def update_connections(self, values):
+        """Write the values of several connections in a single transaction.
+
+        :param values: A dictionary mapping connection primary keys to
+                       dictionaries of values
+        """
+        for pk, connection_values in values.items():
+            self._update_values(pk, connection_values)
+        self.commit()
+
+    def _insert_connection(self, **kwargs):
+        """Create a connection with a single write that does nothing if the
+        connection model's unique index on the provider user conflicts.
+        Returns the connection or `None`."""
+        raise NotImplementedError
+
+    def upsert_connection(self, **kwargs):
+        """Create a connection unless the provider user is already connected.
+        Returns the new connection or `None` if a connection to the provider
+        user exists. When the connection model has a unique index on
+        `provider_id` and `provider_user_id`, as declared by the connection
+        model mixins, this is a single atomic write and concurrent requests
+        can not create duplicate connections."""
+        lookup = CONNECTION_LOOKUPS[0]
+        indexes = self._get_indexes(unique=True) or []
+        if any(fields and set(fields) <= set(lookup) for fields in indexes):
+            return self._insert_connection(**kwargs)
+        query = dict((key, kwargs[key]) for key in lookup)
+        if self.find_connection(fields=('provider_id',), **query) is not None:
+            return None
+        return self.create_connection(**kwargs)
+
     def delete_connection(self, **kwargs):
         """Remove a single connection to a provider for the specified user."""
         conn = self.find_connection(**kwargs)
@@ -41,11 +289,12 @@ class ConnectionDatastore(object):
         return True
 
     def delete_connections(self, **kwargs):
-        """Remove a single connection to a provider for the specified user."""
-        rv = False
+        """Remove all connections matching the specified values and return
+        the number of connections removed."""
+        rv = 0
         for c in self.find_connections(**kwargs):
             self.delete(c)
-            rv = True
+            rv += 1
         return rv
 
 
@@ -56,14 +305,152 @@ class SQLAlchemyConnectionDatastore(SQLAlchemyDatastore, ConnectionDatastore):
         SQLAlchemyDatastore.__init__(self, db)
         ConnectionDatastore.__init__(self, connection_model)
 
-    def _query(self, **kwargs):
-        return self.connection_model.query.filter_by(**kwargs)
+    def _build_query_shape(self, keys, fields):
+        from sqlalchemy import and_, bindparam
+        from sqlalchemy.orm import load_only
+        model = self.connection_model
+        criterion = and_(*[getattr(model, key) == bindparam(key)
+                           for key in keys])
+        options = [load_only(*fields)] if fields else []
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs).first()
+        def shape(values):
+            query = model.query.options(*options)
+            if keys:
+                query = query.filter(criterion).params(**values)
+            return query
+        return shape
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+    def _get_indexes(self, unique=False):
+        from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint
+        table = getattr(self.connection_model, '__table__', None)
+        if table is None:
+            return None
+        indexes = [[c.name for c in i.columns] for i in table.indexes
+                   if i.unique or not unique]
+        indexes.extend([c.name for c in constraint.columns]
+                       for constraint in table.constraints
+                       if isinstance(constraint, (PrimaryKeyConstraint,
+                                                  UniqueConstraint)))
+        indexes.extend([c.name] for c in table.columns
+                       if c.unique or (c.index and not unique))
+        return indexes
+
+    def _insert_connection(self, **kwargs):
+        from sqlalchemy.exc import IntegrityError
+        try:
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+        except ImportError:
+            pg_insert = None
+        model = self.connection_model
+        mapper = model.__mapper__
+        session = self.db.session
+        dialect = session.get_bind(mapper).dialect.name
+        if dialect == 'sqlite':
+            statement = model.__table__.insert().prefix_with('OR IGNORE')
+        elif dialect == 'postgresql' and pg_insert is not None:
+            statement = pg_insert(model.__table__).on_conflict_do_nothing()
+        else:
+            # Fall back to a savepoint that is rolled back on conflict
+            connection = model(**kwargs)
+            try:
+                with session.begin_nested():
+                    session.add(connection)
+            except IntegrityError:
+                return None
+            return connection
+        values = dict((getattr(model, key).property.columns[0].name, value)
+                      for key, value in kwargs.items())
+        result = session.execute(statement.values(**values), mapper=mapper)
+        if not result.rowcount:
+            return None
+        return model.query.get(result.inserted_primary_key)
+
+    def find_connection(self, fields=None, **kwargs):
+        return self._query(fields, **kwargs).first()
+
+    def login_lookup(self, provider_id, provider_user_id):
+        from sqlalchemy.orm import joinedload
+        query = self._query(self._get_login_fields(), provider_id=provider_id,
+                            provider_user_id=provider_user_id)
+        if 'user' in self.connection_model.__mapper__.relationships:
+            query = query.options(joinedload('user'))
+        connection = query.first()
+        if connection is None:
+            return None, None
+        return connection, connection.user
+
+    def _update_values(self, pk, values):
+        # The session applies the values to a loaded connection without
+        # marking it dirty, so the update is not flushed again
+        column = self.connection_model.__mapper__.primary_key[0]
+        query = self.connection_model.query.filter(column == pk)
+        query.update(values, synchronize_session='evaluate')
+
+    def _set_loaded_values(self, connection, values):
+        from sqlalchemy.orm.attributes import set_committed_value
+        for key, value in values.items():
+            set_committed_value(connection, key, value)
+
+    def _update_connection(self, connection, values):
+        self._update_values(self._get_pk(connection), values)
+
+    def _find_connections_chunk(self, after, limit, fields=None, **kwargs):
+        return self._chunk(self._query(fields, **kwargs), after, limit)
+
+    def _find_expiring_chunk(self, after, limit, before, **kwargs):
+        from sqlalchemy import and_, or_
+        model = self.connection_model
+        pk = model.__mapper__.primary_key[0]
+        query = self._query(**kwargs).filter(model.expires_at <= before,
+                                             model.refresh_token != None)
+        if after is not None:
+            expires_at, after = after
+            query = query.filter(or_(model.expires_at > expires_at,
+                                     and_(model.expires_at == expires_at,
+                                          pk > after)))
+        return query.order_by(model.expires_at, pk).limit(limit)
+
+    def _chunk(self, query, after, limit):
+        pk = self.connection_model.__mapper__.primary_key[0]
+        if after is not None:
+            query = query.filter(pk > after)
+        return query.order_by(pk).limit(limit)
+
+    def _get_pk(self, connection):
+        mapper = self.connection_model.__mapper__
+        return mapper.primary_key_from_instance(connection)[0]
+
+    def _has_sequential_pk(self):
+        from sqlalchemy import Integer
+        columns = self.connection_model.__mapper__.primary_key
+        return (len(columns) == 1 and isinstance(columns[0].type, Integer) and
+                columns[0].autoincrement is True)
+
+    def _get_values(self, connection):
+        from sqlalchemy.orm.attributes import instance_state
+        loaded = instance_state(connection).dict
+        return dict((attr.key, loaded[attr.key])
+                    for attr in self.connection_model.__mapper__.column_attrs
+                    if attr.key in loaded)
+
+    def _from_values(self, values):
+        from sqlalchemy.orm import make_transient_to_detached
+        connection = self.connection_model(**values)
+        # Fields that were not loaded are loaded when they are accessed
+        make_transient_to_detached(connection)
+        return self.db.session.merge(connection, load=False)
+
+    def _find_connections_for_users(self, user_ids, provider_ids):
+        model = self.connection_model
+        query = model.query.filter(model.user_id.in_(user_ids))
+        if provider_ids is not None:
+            query = query.filter(model.provider_id.in_(provider_ids))
+        return query
+
+    def delete_connections(self, **kwargs):
+        # The session is synchronized by evaluating the criteria in Python,
+        # which does not work with the bound parameters of a query shape
+        return self.connection_model.query.filter_by(**kwargs).delete()
 
 
 class MongoEngineConnectionDatastore(MongoEngineDatastore, ConnectionDatastore):
@@ -73,20 +460,87 @@ class MongoEngineConnectionDatastore(MongoEngineDatastore, ConnectionDatastore):
         MongoEngineDatastore.__init__(self, db)
         ConnectionDatastore.__init__(self, connection_model)
 
-    def _query(self, **kwargs):
+    def _build_query_shape(self, keys, fields):
+        # The projection is applied once, filtering clones the query set
+        base = self.connection_model.objects
+        if fields:
+            base = base.only(*fields)
+
+        def shape(values):
+            return base.filter(**values)
+        return shape
+
+    def _get_indexes(self, unique=False):
+        specs = self.connection_model._meta.get('index_specs') or []
+        return [[name for name, direction in spec['fields']]
+                for spec in specs
+                if spec.get('unique') or not unique] + [['id']]
+
+    def _insert_connection(self, **kwargs):
+        from mongoengine.errors import OperationError
+        lookup = dict((key, kwargs.pop(key)) for key in CONNECTION_LOOKUPS[0])
+        values = dict(('set_on_insert__%s' % key, value)
+                      for key, value in kwargs.items())
+        query = self.connection_model.objects(**lookup)
         try:
-            from mongoengine.queryset import Q, QCombination
-        except ImportError:
-            from mongoengine.queryset.visitor import Q, QCombination
-        queries = map(lambda i: Q(**{i[0]: i[1]}), kwargs.items())
-        query = QCombination(QCombination.AND, queries)
-        return self.connection_model.objects(query)
+            result = query.update(upsert=True, multi=False, full_result=True,
+                                  **values)
+        except OperationError as e:
+            # A concurrent upsert inserted the same provider user first
+            if u'E1100' not in unicode(e):
+                raise
+            return None
+        if result.get('updatedExisting'):
+            return None
+        return self.connection_model.objects(pk=result['upserted']).first()
+
+    def find_connection(self, fields=None, **kwargs):
+        return self._query(fields, **kwargs).first()
+
+    def _update_values(self, pk, values):
+        self.connection_model.objects(pk=pk).update_one(
+            **dict(('set__%s' % key, value) for key, value in values.items()))
+
+    def _find_connections_chunk(self, after, limit, fields=None, **kwargs):
+        return self._chunk(self._query(fields, **kwargs), after, limit)
+
+    def _find_expiring_chunk(self, after, limit, before, **kwargs):
+        from mongoengine import Q
+        query = self._query(**kwargs).filter(expires_at__lte=before,
+                                             refresh_token__ne=None)
+        if after is not None:
+            expires_at, after = after
+            query = query.filter(Q(expires_at__gt=expires_at) |
+                                 Q(expires_at=expires_at, pk__gt=after))
+        return query.order_by('expires_at', 'pk').limit(limit)
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs).first()
+    def _chunk(self, query, after, limit):
+        if after is not None:
+            query = query.filter(pk__gt=after)
+        return query.order_by('pk').limit(limit)
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+    def _get_pk(self, connection):
+        return connection.pk
+
+    def _get_values(self, connection):
+        return dict(connection._data)
+
+    def _from_values(self, values):
+        return self.connection_model(_created=False, **values)
+
+    def _find_connections_for_users(self, user_ids, provider_ids):
+        query = dict(user_id__in=user_ids)
+        if provider_ids is not None:
+            query['provider_id__in'] = provider_ids
+        return self.connection_model.objects(**query)
+
+    def delete_connections(self, **kwargs):
+        # QuerySet.delete does not report the number of removed documents
+        query = self._query(**kwargs)
+        rv = query.count()
+        if rv:
+            query.delete()
+        return rv
 
 
 class PeeweeConnectionDatastore(PeeweeDatastore, ConnectionDatastore):
@@ -96,21 +550,642 @@ class PeeweeConnectionDatastore(PeeweeDatastore, ConnectionDatastore):
         PeeweeDatastore.__init__(self, db)
         ConnectionDatastore.__init__(self, connection_model)
 
-    def _query(self, **kwargs):
+    def _build_query_shape(self, keys, fields):
+        model = self.connection_model
+
+        def field(name):
+            return getattr(model, 'user' if name == 'user_id' else name)
+
+        # Model.filter joins the related tables, a plain select does not
+        columns = [(key, field(key)) for key in keys]
+        selected = []
+        if fields:
+            selected = [model._meta.primary_key]
+            selected.extend(field(name) for name in fields
+                            if field(name) is not model._meta.primary_key)
+        # The select is built once, adding the criteria clones it
+        base = model.select(*selected)
+
+        def shape(values):
+            if not columns:
+                return base.clone()
+            return base.where(*[column == values[key]
+                                for key, column in columns])
+        return shape
+
+    def _get_indexes(self, unique=False):
+        meta = self.connection_model._meta
+
+        def column(name):
+            return 'user_id' if name == 'user' else name
+
+        indexes = [[column(name) for name in fields]
+                   for fields, is_unique in meta.indexes
+                   if is_unique or not unique]
+        indexes.extend([column(field.name)]
+                       for field in self.connection_model._fields_to_index()
+                       if field.unique or not unique)
+        indexes.append([column(meta.primary_key.name)])
+        return indexes
+
+    def _has_sequential_pk(self):
+        from peewee import PrimaryKeyField
+        return isinstance(self.connection_model._meta.primary_key,
+                          PrimaryKeyField)
+
+    def create_connection(self, **kwargs):
         if 'user_id' in kwargs:
             kwargs['user'] = kwargs.pop('user_id')
+        return self.put(self.connection_model(**kwargs))
+
+    def _insert_connection(self, **kwargs):
+        from peewee import IntegrityError
+        try:
+            with self.connection_model._meta.database.atomic():
+                return self.create_connection(**kwargs)
+        except IntegrityError:
+            return None
+
+    def find_connection(self, fields=None, **kwargs):
         try:
-            return self.connection_model.filter(**kwargs).get()
+            return self._query(fields, **kwargs).get()
         except self.connection_model.DoesNotExist:
             return None
 
-    def create_connection(self, **kwargs):
+    def login_lookup(self, provider_id, provider_user_id):
+        model = self.connection_model
+        user_model = model.user.rel_model
+        columns = [getattr(model, 'user' if name == 'user_id' else name)
+                   for name in self._get_login_fields()]
+        query = model.select(model._meta.primary_key, user_model, *columns) \
+            .join(user_model) \
+            .where(model.provider_id == provider_id,
+                   model.provider_user_id == provider_user_id)
+        try:
+            connection = query.get()
+        except model.DoesNotExist:
+            return None, None
+        return connection, connection.user
+
+    def _update_values(self, pk, values):
+        model = self.connection_model
+        model.update(**values).where(model._meta.primary_key == pk).execute()
+
+    def update_connections(self, values):
+        with self.connection_model._meta.database.atomic():
+            ConnectionDatastore.update_connections(self, values)
+
+    def _find_connections_chunk(self, after, limit, fields=None, **kwargs):
+        return self._chunk(self._query(fields, **kwargs), after, limit)
+
+    def _find_expiring_chunk(self, after, limit, before, **kwargs):
+        model = self.connection_model
+        pk = model._meta.primary_key
+        query = self._query(**kwargs).where(model.expires_at <= before,
+                                            model.refresh_token.is_null(False))
+        if after is not None:
+            expires_at, after = after
+            query = query.where((model.expires_at > expires_at) |
+                                ((model.expires_at == expires_at) &
+                                 (pk > after)))
+        return query.order_by(model.expires_at, pk).limit(limit)
+
+    def _chunk(self, query, after, limit):
+        pk = self.connection_model._meta.primary_key
+        if after is not None:
+            query = query.where(pk > after)
+        return query.order_by(pk).limit(limit)
+
+    def _get_pk(self, connection):
+        return connection._get_pk_value()
+
+    def _get_values(self, connection):
+        return dict(connection._data)
+
+    def _from_values(self, values):
+        return self.connection_model(**values)
+
+    def _find_connections_for_users(self, user_ids, provider_ids):
+        model = self.connection_model
+        query = model.select().where(model.user << user_ids)
+        if provider_ids is not None:
+            query = query.where(model.provider_id << provider_ids)
+        return query
+
+    def _get_user_id(self, connection):
+        return connection._data['user']
+
+    def delete_connections(self, **kwargs):
         if 'user_id' in kwargs:
             kwargs['user'] = kwargs.pop('user_id')
-        return self.put(self.connection_model(**kwargs))
+        model = self.connection_model
+        query = model.delete()
+        for key, value in kwargs.items():
+            query = query.where(getattr(model, key) == value)
+        return query.execute()
+
+
+class SQLiteConnection(object):
+    """A connection stored by :class:`SQLiteConnectionDatastore`. Fields that
+    were not loaded are `None`."""
+
+    #: The names of the connection fields other than the primary key `id`
+    fields = ('user_id', 'provider_id', 'provider_user_id', 'access_token',
+              'secret', 'refresh_token', 'expires_at', 'display_name',
+              'full_name', 'email', 'profile_url', 'image_url', 'rank')
+
+    id = user_id = provider_id = provider_user_id = access_token = None
+    secret = refresh_token = expires_at = display_name = full_name = None
+    email = profile_url = image_url = rank = None
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def _from_row(cls, columns, row):
+        connection = cls.__new__(cls)
+        connection.__dict__.update(zip(columns, row))
+        return connection
+
+    @property
+    def user(self):
+        """The connection's user, loaded with the Flask-Security user
+        datastore."""
+        security = current_app.extensions['security']
+        return security.datastore.get_user(self.user_id)
+
+
+class SQLiteConnectionDatastore(ConnectionDatastore):
+    """A datastore implementation for Flask-Social storing connections in a
+    SQLite database with the :mod:`sqlite3` module, without an ORM or a
+    connection model. The connection table and its indexes are created when
+    the database is first used. Each thread uses its own database connection
+    in WAL mode, so lookups are not blocked by writes, and each statement is
+    prepared once per database connection. Writes are committed together by
+    :meth:`commit`.
+
+    :param path: The path of the database file. An in-memory database is
+                 not shared between threads.
+    :param table: The name of the connection table
+    """
+
+    def __init__(self, path, table='connection'):
+        ConnectionDatastore.__init__(self, SQLiteConnection)
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        self._columns = frozenset(('id',) + SQLiteConnection.fields)
+        self._insert = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+            table, ', '.join(SQLiteConnection.fields),
+            ', '.join('?' * len(SQLiteConnection.fields)))
+        self._update = 'UPDATE "%s" SET %s WHERE id = ?' % (
+            table, ', '.join('%s = ?' % name
+                             for name in SQLiteConnection.fields))
+        self._delete = 'DELETE FROM "%s" WHERE id = ?' % table
+
+    def _create_table(self, db):
+        table = self.table
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS "%(table)s" (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                provider_id TEXT NOT NULL,
+                provider_user_id TEXT NOT NULL,
+                access_token TEXT,
+                secret TEXT,
+                refresh_token TEXT,
+                expires_at TIMESTAMP,
+                display_name TEXT,
+                full_name TEXT,
+                email TEXT,
+                profile_url TEXT,
+                image_url TEXT,
+                rank INTEGER,
+                UNIQUE (provider_id, provider_user_id)
+            );
+            CREATE INDEX IF NOT EXISTS "ix_%(table)s_login" ON "%(table)s"
+                (%(login)s);
+            CREATE INDEX IF NOT EXISTS "ix_%(table)s_user_provider"
+                ON "%(table)s" (user_id, provider_id);
+        ''' % dict(table=table, login=', '.join(self._get_login_index())))
+
+    def _get_login_index(self):
+        # Covers the login lookup, so it does not read the table
+        return CONNECTION_LOOKUPS[0][::-1] + tuple(
+            name for name in LOGIN_FIELDS if name not in CONNECTION_LOOKUPS[0])
+
+    def _has_sequential_pk(self):
+        return True
+
+    @property
+    def db(self):
+        """The current thread's database connection."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path,
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._create_table(db)
+            db.commit()
+            self._local.db = db
+        return db
+
+    def init_app(self, app):
+        """Roll back the writes that were not committed when an application
+        context ends. Called by :class:`~flask_social.core.Social`."""
+        app.teardown_appcontext(self.rollback)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self, exception=None):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.rollback()
+
+    def _check_columns(self, names):
+        for name in names:
+            if name not in self._columns:
+                raise ValueError('Connections have no field %s' % name)
+
+    def put(self, connection):
+        values = [getattr(connection, name) for name in SQLiteConnection.fields]
+        if connection.id is None:
+            connection.id = self.db.execute(self._insert, values).lastrowid
+        else:
+            self.db.execute(self._update, values + [connection.id])
+        return connection
+
+    def delete(self, connection):
+        self.db.execute(self._delete, (connection.id,))
+
+    def _build_query_shape(self, keys, fields):
+        self._check_columns(keys + (fields or ()))
+        columns = ('id',) + tuple(name for name in
+                                  fields or SQLiteConnection.fields
+                                  if name != 'id')
+        source = '"%s"' % self.table
+        login = ('id',) + self._get_login_index()
+        if (set(keys) == set(CONNECTION_LOOKUPS[0]) and
+                set(columns) <= set(login)):
+            # SQLite prefers the unique index, which does not cover the
+            # fields read when logging in
+            source += ' INDEXED BY "ix_%s_login"' % self.table
+        select = 'SELECT %s FROM %s' % (', '.join(columns), source)
+        criteria = ['%s = ?' % key for key in keys]
+
+        def where(criteria):
+            return ' WHERE ' + ' AND '.join(criteria) if criteria else ''
+
+        # The statements are built once, so sqlite3 reuses their prepared
+        # statements
+        expiring = criteria + ['expires_at <= ?',
+                               'refresh_token IS NOT NULL']
+        statements = dict(
+            one=select + where(criteria) + ' LIMIT 1',
+            first=select + where(criteria) + ' ORDER BY id LIMIT ?',
+            after=select + where(criteria + ['id > ?']) +
+            ' ORDER BY id LIMIT ?',
+            expiring_first=select + where(expiring) +
+            ' ORDER BY expires_at, id LIMIT ?',
+            expiring_after=select + where(expiring + [
+                '(expires_at > ? OR expires_at = ? AND id > ?)']) +
+            ' ORDER BY expires_at, id LIMIT ?',
+            delete='DELETE FROM "%s"%s' % (self.table, where(criteria)))
+
+        def shape(values):
+            return statements, columns, [values[key] for key in keys]
+        return shape
+
+    def _get_indexes(self, unique=False):
+        indexes = [['id'], list(CONNECTION_LOOKUPS[0][::-1])]
+        if not unique:
+            indexes.append(list(self._get_login_index()))
+            indexes.append(['user_id', 'provider_id'])
+        return indexes
+
+    def find_connection(self, fields=None, **kwargs):
+        statements, columns, params = self._query(fields, **kwargs)
+        row = self.db.execute(statements['one'], params).fetchone()
+        if row is None:
+            return None
+        return SQLiteConnection._from_row(columns, row)
+
+    def _find_connections_chunk(self, after, limit, fields=None, **kwargs):
+        statements, columns, params = self._query(fields, **kwargs)
+        if after is None:
+            rows = self.db.execute(statements['first'], params + [limit])
+        else:
+            rows = self.db.execute(statements['after'],
+                                   params + [after, limit])
+        return [SQLiteConnection._from_row(columns, row) for row in rows]
+
+    def _find_expiring_chunk(self, after, limit, before, **kwargs):
+        statements, columns, params = self._query(**kwargs)
+        if after is None:
+            rows = self.db.execute(statements['expiring_first'],
+                                   params + [before, limit])
+        else:
+            expires_at, after = after
+            rows = self.db.execute(statements['expiring_after'],
+                                   params + [before, expires_at, expires_at,
+                                             after, limit])
+        return [SQLiteConnection._from_row(columns, row) for row in rows]
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs)
+    def _find_connections_for_users(self, user_ids, provider_ids):
+        columns = ('id',) + SQLiteConnection.fields
+        sql = 'SELECT %s FROM "%s" WHERE user_id IN (%s)' % (
+            ', '.join(columns), self.table, ', '.join('?' * len(user_ids)))
+        params = list(user_ids)
+        if provider_ids is not None:
+            sql += ' AND provider_id IN (%s)' % ', '.join(
+                '?' * len(provider_ids))
+            params.extend(provider_ids)
+        return [SQLiteConnection._from_row(columns, row)
+                for row in self.db.execute(sql, params)]
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+    def _update_values(self, pk, values):
+        keys = sorted(values)
+        self._check_columns(keys)
+        sql = 'UPDATE "%s" SET %s WHERE id = ?' % (
+            self.table, ', '.join('%s = ?' % key for key in keys))
+        self.db.execute(sql, [values[key] for key in keys] + [pk])
+
+    def _insert_connection(self, **kwargs):
+        keys = sorted(kwargs)
+        self._check_columns(keys)
+        sql = 'INSERT OR IGNORE INTO "%s" (%s) VALUES (%s)' % (
+            self.table, ', '.join(keys), ', '.join('?' * len(keys)))
+        cursor = self.db.execute(sql, [kwargs[key] for key in keys])
+        if not cursor.rowcount:
+            return None
+        return SQLiteConnection(id=cursor.lastrowid, **kwargs)
+
+    def _get_values(self, connection):
+        return dict(connection.__dict__)
+
+    def _from_values(self, values):
+        return SQLiteConnection(**values)
+
+    def delete_connections(self, **kwargs):
+        statements, columns, params = self._query(**kwargs)
+        return self.db.execute(statements['delete'], params).rowcount
+
+
+class CachingConnectionDatastore(object):
+    """A read-through cache in front of another connection datastore. Lookups
+    of a provider user's connection and of a user's connections are cached,
+    including lookups that find nothing, and other lookups are passed to the
+    datastore. Cached lookups of a connection are discarded when the
+    connection is created, written or deleted through this datastore or when
+    a `connection_created` signal is sent for it. Deleting connections by
+    other values than a provider user discards all cached lookups, without
+    loading the deleted connections.
+
+    Concurrent misses of the same lookup are loaded once: the first request
+    loads the lookup while the others wait up to `lock_timeout` seconds for
+    it to be cached. Logging in caches the login fields and the user ID of
+    the connection and loads the user with the Flask-Security user datastore.
+    The absence of a connection is only cached for `negative_timeout`
+    seconds: discarding lookups only reaches other processes through a shared
+    cache, so with an in-process cache a provider user connected by another
+    process can be refused a login for that long.
+
+    :param datastore: The connection datastore
+    :param cache: A :class:`~flask_social.cache.KeyValueCache`, defaults to an
+                  in-process LRU cache of 10000 items kept for 5 minutes
+    :param serializer: An object with `dumps` and `loads` methods, defaults
+                       to pickle
+    :param lock_timeout: The number of seconds a miss waits for another
+                         request loading the same lookup
+    :param max_results: The largest number of connections cached for a
+                        single `find_connections` lookup
+    :param negative_timeout: The number of seconds a login lookup finding no
+                             connection is cached. `0` does not cache it.
+    """
+
+    #: The number of seconds between checks of a lookup being loaded
+    lock_interval = 0.01
+
+    def __init__(self, datastore, cache=None, serializer=None,
+                 lock_timeout=1, max_results=100, negative_timeout=5):
+        self.datastore = datastore
+        self.cache = cache if cache is not None else LRUCache(10000, 300)
+        self.serializer = serializer or PickleSerializer()
+        self.lock_timeout = lock_timeout
+        self.max_results = max_results
+        self.negative_timeout = negative_timeout
+        self._local = threading.local()
+        # Not connected to connection_removed, whose receivers decide whether
+        # remove_all_connections loads the removed connections
+        connection_created.connect(self._on_connection_created)
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+    def _get_generation(self, key):
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            if not self.cache.add(key, generation):
+                generation = self.cache.get(key) or generation
+        return generation
+
+    def _get_families(self, connection):
+        user_id = self.datastore._get_user_id(connection)
+        families = [('user', unicode(user_id))]
+        if None not in (connection.provider_id, connection.provider_user_id):
+            families.append(('identity', unicode(connection.provider_id),
+                             unicode(connection.provider_user_id)))
+        return families
+
+    def _get_key(self, lookup, fields, kwargs):
+        if 'provider_id' in kwargs and 'provider_user_id' in kwargs:
+            family = ('identity', unicode(kwargs['provider_id']),
+                      unicode(kwargs['provider_user_id']))
+        elif 'user_id' in kwargs:
+            family = ('user', unicode(kwargs['user_id']))
+        else:
+            return None
+        generations = (self._get_generation('social:generation'),
+                       self._get_generation(self._get_family_key(family)))
+        values = sorted((key, unicode(value)) for key, value in kwargs.items())
+        data = repr((generations, lookup, fields and tuple(fields), values))
+        return 'social:lookup:%s' % hashlib.sha1(data).hexdigest()
+
+    def _get_family_key(self, family):
+        data = repr(family)
+        return 'social:generation:%s' % hashlib.sha1(data).hexdigest()
+
+    def _invalidate(self, families=None):
+        if families is None:
+            self.cache.set('social:generation', uuid.uuid4().hex)
+            return
+        for family in families:
+            self.cache.set(self._get_family_key(family), uuid.uuid4().hex)
+
+    def invalidate(self, connection=None):
+        """Discard the cached lookups of a connection or, without a
+        connection, all cached lookups. Lookups are discarded again when the
+        datastore is committed, so that concurrent requests do not cache the
+        values the connection had before the commit."""
+        families = None
+        if connection is not None:
+            families = self._get_families(connection)
+        self._invalidate(families)
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = []
+        pending.append(families)
+
+    def _on_connection_created(self, app, connection=None, **kwargs):
+        state = app.extensions.get('social')
+        if (connection is not None and state is not None and
+                state.datastore is self):
+            self.invalidate(connection)
+
+    def _read_through(self, key, load):
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        lock_key = key + ':lock'
+        while not self.cache.add(lock_key,
+                                 repr(time.time() + self.lock_timeout)):
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+            expires = self.cache.get(lock_key)
+            if expires is None or float(expires) < time.time():
+                self.cache.delete(lock_key)
+                continue
+            time.sleep(self.lock_interval)
+        try:
+            # Another request may have cached the lookup before the lock was
+            # taken
+            value = self.cache.get(key)
+            if value is None:
+                value = load()
+                self.cache.set(key, value)
+        finally:
+            self.cache.delete(lock_key)
+        return value
+
+    def _dumps(self, connection):
+        if connection is not None:
+            connection = self.datastore._get_values(connection)
+        return self.serializer.dumps(connection)
+
+    def _loads(self, value):
+        values = self.serializer.loads(value)
+        if values is None:
+            return None
+        return self.datastore._from_values(values)
+
+    def find_connection(self, fields=None, **kwargs):
+        key = self._get_key('one', fields, kwargs)
+        if key is None:
+            return self.datastore.find_connection(fields=fields, **kwargs)
+
+        def load():
+            return self._dumps(
+                self.datastore.find_connection(fields=fields, **kwargs))
+        return self._loads(self._read_through(key, load))
+
+    def find_connections(self, fields=None, **kwargs):
+        key = self._get_key('all', fields, kwargs)
+        values = self.cache.get(key) if key is not None else None
+        if values is not None:
+            for value in self.serializer.loads(values):
+                yield self._loads(value)
+            return
+        values = [] if key is not None else None
+        for connection in self.datastore.find_connections(fields=fields,
+                                                          **kwargs):
+            if values is not None:
+                values.append(self._dumps(connection))
+                if len(values) > self.max_results:
+                    values = None
+            yield connection
+        if values is not None:
+            self.cache.set(key, self.serializer.dumps(values))
+
+    def _get_user(self, user_id):
+        security = current_app.extensions['security']
+        return security.datastore.get_user(user_id)
+
+    def login_lookup(self, provider_id, provider_user_id):
+        key = self._get_key('login', None, dict(
+            provider_id=provider_id, provider_user_id=provider_user_id))
+        value = self.cache.get(key)
+        if value is not None:
+            value = self.serializer.loads(value)
+            if value is None:
+                return None, None
+            values, user_id = value
+            user = self._get_user(user_id)
+            if user is not None:
+                return self.datastore._from_values(values), user
+        connection, user = self.datastore.login_lookup(provider_id,
+                                                       provider_user_id)
+        if connection is None:
+            if self.negative_timeout:
+                self.cache.set(key, self._dumps(None), self.negative_timeout)
+        else:
+            datastore = self.datastore
+            self.cache.set(key, self.serializer.dumps(
+                (datastore._get_values(connection),
+                 datastore._get_user_id(connection))))
+        return connection, user
+
+    def commit(self):
+        self.datastore.commit()
+        pending = getattr(self._local, 'pending', None) or []
+        self._local.pending = []
+        for families in pending:
+            self._invalidate(families)
+
+    def put(self, model):
+        rv = self.datastore.put(model)
+        if isinstance(model, self.datastore.connection_model):
+            self.invalidate(model)
+        return rv
+
+    def delete(self, model):
+        if isinstance(model, self.datastore.connection_model):
+            self.invalidate(model)
+        self.datastore.delete(model)
+
+    def create_connection(self, **kwargs):
+        connection = self.datastore.create_connection(**kwargs)
+        self.invalidate(connection)
+        return connection
+
+    def upsert_connection(self, **kwargs):
+        connection = self.datastore.upsert_connection(**kwargs)
+        if connection is not None:
+            self.invalidate(connection)
+        return connection
+
+    def update_connection(self, connection, **values):
+        rv = self.datastore.update_connection(connection, **values)
+        if rv:
+            self.invalidate(connection)
+        return rv
+
+    def update_connections(self, values):
+        self.datastore.update_connections(values)
+        self._invalidate()
+
+    def delete_connection(self, **kwargs):
+        connection = self.datastore.find_connection(**kwargs)
+        if connection is None:
+            return False
+        self.delete(connection)
+        return True
+
+    def delete_connections(self, **kwargs):
+        rv = self.datastore.delete_connections(**kwargs)
+        self.invalidate()
+        return rv
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.models
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains connection model mixins declaring the fields and
+    indexes Flask-Social expects. Each mixin is only available when its
+    database library is installed.
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+try:
+    from sqlalchemy import Column, DateTime, Index, Integer, String, \
+        UniqueConstraint
+    from sqlalchemy.ext.declarative import declared_attr
+except ImportError:
+    pass
+else:
+    class SQLAlchemyConnectionMixin(object):
+        """A SQLAlchemy declarative mixin for connection models. The model
+        defines its own primary key and the `user_id` foreign key, for
+        example::
+
+            class Connection(db.Model, SQLAlchemyConnectionMixin):
+                id = db.Column(db.Integer, primary_key=True)
+                user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+        """
+
+        provider_id = Column(String(255), nullable=False)
+        provider_user_id = Column(String(255), nullable=False)
+        access_token = Column(String(255))
+        secret = Column(String(255))
+        refresh_token = Column(String(255))
+        expires_at = Column(DateTime)
+        display_name = Column(String(255))
+        full_name = Column(String(255))
+        email = Column(String(255))
+        profile_url = Column(String(512))
+        image_url = Column(String(512))
+        rank = Column(Integer)
+
+        @declared_attr
+        def __table_args__(cls):
+            return (
+                UniqueConstraint('provider_id', 'provider_user_id',
+                                 name='uq_%s_provider' % cls.__tablename__),
+                Index('ix_%s_user_provider' % cls.__tablename__, 'user_id',
+                      'provider_id')
+            )
+
+
+try:
+    import mongoengine
+except ImportError:
+    pass
+else:
+    class MongoEngineConnectionMixin(object):
+        """A MongoEngine mixin for connection documents, based on either
+        `mongoengine.Document` or Flask-MongoEngine's `db.Document`. The
+        document defines its own `user_id` field, for example::
+
+            class Connection(db.Document, MongoEngineConnectionMixin):
+                user_id = db.ObjectIdField()
+        """
+
+        provider_id = mongoengine.StringField(required=True, max_length=255)
+        provider_user_id = mongoengine.StringField(required=True,
+                                                   max_length=255)
+        access_token = mongoengine.StringField(max_length=255)
+        secret = mongoengine.StringField(max_length=255)
+        refresh_token = mongoengine.StringField(max_length=255)
+        expires_at = mongoengine.DateTimeField()
+        display_name = mongoengine.StringField(max_length=255)
+        full_name = mongoengine.StringField(max_length=255)
+        email = mongoengine.StringField(max_length=255)
+        profile_url = mongoengine.StringField(max_length=512)
+        image_url = mongoengine.StringField(max_length=512)
+        rank = mongoengine.IntField()
+
+        meta = {
+            'indexes': [
+                {'fields': ('provider_id', 'provider_user_id'),
+                 'unique': True},
+                ('user_id', 'provider_id')
+            ]
+        }
+
+
+try:
+    import peewee
+except ImportError:
+    pass
+else:
+    class PeeweeConnectionMixin(peewee.Model):
+        """A Peewee mixin for connection models. The model defines its own
+        `user` foreign key and lists the mixin after its base model. Peewee
+        only inherits the Meta options of the first base model, so the model
+        declares the mixin's indexes in its own Meta, for example::
+
+            class Connection(db.Model, PeeweeConnectionMixin):
+                user = ForeignKeyField(User, related_name='connections')
+
+                class Meta:
+                    indexes = PeeweeConnectionMixin._meta.indexes
+        """
+
+        provider_id = peewee.TextField()
+        provider_user_id = peewee.TextField()
+        access_token = peewee.TextField(null=True)
+        secret = peewee.TextField(null=True)
+        refresh_token = peewee.TextField(null=True)
+        expires_at = peewee.DateTimeField(null=True)
+        display_name = peewee.TextField(null=True)
+        full_name = peewee.TextField(null=True)
+        email = peewee.TextField(null=True)
+        profile_url = peewee.TextField(null=True)
+        image_url = peewee.TextField(null=True)
+        rank = peewee.IntegerField(null=True)
+
+        class Meta:
+            indexes = ((('provider_id', 'provider_user_id'), True),
+                       (('user', 'provider_id'), False))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.providers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social provider adapters
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+
+from functools import wraps
+
+from ..cache import LRUCache
+from ..transport import HTTPResponse
+
+#: Recently fetched provider profiles keyed by provider and access token
+profile_cache = LRUCache(maxsize=1000, ttl=60)
+
+
+def report_response(response_hook, status, headers):
+    """Pass a response received by a provider's API library to the
+    `response_hook` given to `get_api`, if any.
+
+    :param response_hook: The hook or `None`
+    :param status: The response status
+    :param headers: The response headers
+    """
+    if response_hook is not None:
+        headers = dict((str(k).lower(), v) for k, v in headers.items()
+                       if v is not None)
+        response_hook(HTTPResponse(status, headers, None))
+
+
+def cached_profile(provider_id):
+    """Decorate a function fetching a provider profile for an access token,
+    passed as the first argument, so that the profile is fetched once per
+    token. `get_provider_user_id` and `get_connection_values` then share a
+    single profile request, including across a failed login followed by a
+    connect with the same token.
+
+    :param provider_id: The provider ID
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(access_token, *args, **kwargs):
+            token = hashlib.sha1(access_token.encode('utf-8')).hexdigest()
+            key = (provider_id, token)
+            profile = profile_cache.get(key)
+            if profile is None:
+                profile = fn(access_token, *args, **kwargs)
+                profile_cache.set(key, profile)
+            return profile
+        return wrapper
+    return decorator
+
+
+class ProviderAdapter(object):
+    """The interface used by Flask-Social to talk to a provider's API. An
+    adapter is bound once to each :class:`OAuthRemoteApp`.
+
+    :param provider: The provider the adapter is bound to
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def get_api(self, connection, response_hook=None):
+        """Return a configured API client for the specified connection.
+
+        :param connection: The connection
+        :param response_hook: A callable the client passes each response it
+                              receives to as a
+                              :class:`~flask_social.transport.HTTPResponse`
+                              without content, if the API library allows.
+                              Only given when the provider has a
+                              `rate_limit`.
+        """
+        raise NotImplementedError
+
+    def get_provider_user_id(self, response):
+        """Return the provider's user ID from an OAuth response."""
+        raise NotImplementedError
+
+    def get_connection_values(self, response):
+        """Return a dictionary of connection values from an OAuth response."""
+        raise NotImplementedError
+
+    def get_token_pair(self, response):
+        """Return a dictionary with the `access_token` and `secret` from an
+        OAuth response."""
+        raise NotImplementedError
+
+    #: The number of connections passed to :meth:`get_profiles` at once.
+    #: `None` if the provider has no bulk profile endpoint.
+    profiles_batch_size = None
+
+    def get_profiles(self, connections):
+        """Return the current `display_name`, `full_name`, `profile_url` and
+        `image_url` values of several connections, keyed by provider user
+        ID."""
+        raise NotImplementedError
+
+
+class ModuleProviderAdapter(ProviderAdapter):
+    """A provider adapter that delegates to the functions of a provider
+    module, such as :mod:`flask_social.providers.twitter`. A provider module
+    may customize its adapter by defining `adapter_class`.
+
+    :param provider: The provider the adapter is bound to
+    :param module: The provider module
+    """
+
+    required_functions = ('get_api', 'get_provider_user_id',
+                          'get_connection_values',
+                          'get_token_pair_from_response')
+
+    def __init__(self, provider, module):
+        missing = [name for name in self.required_functions
+                   if not callable(getattr(module, name, None))]
+        if missing:
+            raise ImportError('Provider module %s does not define %s' %
+                              (module.__name__, ', '.join(missing)))
+        ProviderAdapter.__init__(self, provider)
+        self.module = module
+
+    def get_api(self, connection, response_hook=None):
+        return self.module.get_api(
+            connection=connection,
+            consumer_key=self.provider.consumer_key,
+            consumer_secret=self.provider.consumer_secret,
+            response_hook=response_hook)
+
+    def get_provider_user_id(self, response):
+        return self.module.get_provider_user_id(response)
+
+    def get_connection_values(self, response):
+        return self.module.get_connection_values(
+            response,
+            consumer_key=self.provider.consumer_key,
+            consumer_secret=self.provider.consumer_secret)
+
+    def get_token_pair(self, response):
+        return self.module.get_token_pair_from_response(response)
+
+    @property
+    def profiles_batch_size(self):
+        return getattr(self.module, 'profiles_batch_size', None)
+
+    def get_profiles(self, connections):
+        return self.module.get_profiles(
+            connections,
+            consumer_key=self.provider.consumer_key,
+            consumer_secret=self.provider.consumer_secret)
@@ -11,8 +11,14 @@
 
 from __future__ import absolute_import
 
+import json
+import urllib
+
 import facebook
 
+from flask_social.providers import cached_profile
+from flask_social.transport import HTTPError, get_transport
+
 config = {
     'id': 'facebook',
     'name': 'Facebook',
@@ -28,14 +34,23 @@ config = {
 }
 
 
+#: The maximum number of requests in a Graph API batch request
+profiles_batch_size = 50
+
+
 def get_api(connection, **kwargs):
     return facebook.GraphAPI(getattr(connection, 'access_token'))
 
 
+@cached_profile(config['id'])
+def _get_profile(access_token):
+    return get_transport().get_json(config['base_url'] + 'me',
+                                    dict(access_token=access_token))
+
+
 def get_provider_user_id(response, **kwargs):
     if response:
-        graph = facebook.GraphAPI(response['access_token'])
-        profile = graph.get_object("me")
+        profile = _get_profile(response['access_token'])
         return profile['id']
     return None
 
@@ -45,23 +60,52 @@ def get_connection_values(response, **kwargs):
         return None
 
     access_token = response['access_token']
-    graph = facebook.GraphAPI(access_token)
-    profile = graph.get_object("me")
-    profile_url = "http://facebook.com/profile.php?id=%s" % profile['id']
-    image_url = "http://graph.facebook.com/%s/picture" % profile['id']
+    profile = _get_profile(access_token)
 
-    return dict(
+    rv = dict(
         provider_id=config['id'],
         provider_user_id=profile['id'],
         access_token=access_token,
         secret=None,
+        email=profile.get('email', '')
+    )
+    rv.update(_get_profile_values(profile))
+    return rv
+
+
+def _get_profile_values(profile):
+    return dict(
         display_name=profile.get('username', None),
         full_name = profile.get('name', None),
-        profile_url=profile_url,
-        image_url=image_url,
-        email=profile.get('email', '')
+        profile_url="http://facebook.com/profile.php?id=%s" % profile['id'],
+        image_url="http://graph.facebook.com/%s/picture" % profile['id']
     )
 
+
+def get_profiles(connections, **kwargs):
+    """Fetch the profiles of several connections with one Graph API batch
+    request authenticated with the app access token."""
+    app_token = '%s|%s' % (kwargs.get('consumer_key'),
+                           kwargs.get('consumer_secret'))
+    batch = [dict(method='GET',
+                  relative_url='%s?fields=id,name,username' %
+                               c.provider_user_id)
+             for c in connections]
+    body = urllib.urlencode(dict(access_token=app_token,
+                                 batch=json.dumps(batch)))
+    url = config['base_url']
+    resp = get_transport().request(url, method='POST', body=body, headers={
+        'Content-Type': 'application/x-www-form-urlencoded'})
+    if resp.status >= 400:
+        raise HTTPError(url, resp)
+
+    rv = {}
+    for item in json.loads(resp.content):
+        if item and item.get('code') == 200:
+            profile = json.loads(item['body'])
+            rv[profile['id']] = _get_profile_values(profile)
+    return rv
+
 def get_token_pair_from_response(response):
     return dict(
         access_token = response.get('access_token', None),
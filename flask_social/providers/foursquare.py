@@ -14,6 +14,9 @@ from __future__ import absolute_import
 import foursquare
 import urlparse
 
+from flask_social.providers import cached_profile, report_response
+from flask_social.transport import get_transport
+
 config = {
     'id': 'foursquare',
     'name': 'foursquare',
@@ -26,16 +29,49 @@ config = {
 }
 
 
+class _Foursquare(foursquare.Foursquare):
+    """A :class:`foursquare.Foursquare` passing the rate limit of each
+    response to `response_hook`. The library only keeps the rate limit
+    headers of its responses."""
+
+    class Requester(foursquare.Foursquare.Requester):
+
+        response_hook = None
+
+        def _report(self):
+            report_response(self.response_hook, 200, {
+                'x-ratelimit-limit': self.rate_limit,
+                'x-ratelimit-remaining': self.rate_remaining})
+
+        def GET(self, path, params={}, **kwargs):
+            rv = foursquare.Foursquare.Requester.GET(self, path, params,
+                                                     **kwargs)
+            if not kwargs.get('multi'):
+                self._report()
+            return rv
+
+        def POST(self, path, data={}, files=None):
+            rv = foursquare.Foursquare.Requester.POST(self, path, data, files)
+            self._report()
+            return rv
+
+
 def get_api(connection, **kwargs):
-    return foursquare.Foursquare(
-            access_token=getattr(connection, 'access_token'))
+    api = _Foursquare(access_token=getattr(connection, 'access_token'))
+    api.base_requester.response_hook = kwargs.get('response_hook')
+    return api
+
+
+@cached_profile(config['id'])
+def _get_user(access_token):
+    params = dict(oauth_token=access_token, v=foursquare.API_VERSION)
+    rv = get_transport().get_json(config['base_url'] + 'users/self', params)
+    return rv['response']['user']
 
 
 def get_provider_user_id(response, **kwargs):
     if response:
-        api = foursquare.Foursquare(
-            access_token=getattr(response, 'access_token'))
-        return api.users()['user']['id']
+        return _get_user(response['access_token'])['id']
     return None
 
 
@@ -44,8 +80,7 @@ def get_connection_values(response, **kwargs):
         return None
 
     access_token = response['access_token']
-    api = foursquare.Foursquare(access_token=access_token)
-    user = api.users()['user']
+    user = _get_user(access_token)
     profile_url = 'http://www.foursquare.com/user/' + user['id']
     image_url = urlparse.urljoin(user['photo']['prefix'],
                                  user['photo']['suffix'])
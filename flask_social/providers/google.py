@@ -11,9 +11,24 @@
 
 from __future__ import absolute_import
 
+import base64
+import json
+import re
+import threading
+import time
+
 import httplib2
 import oauth2client.client as googleoauth
 import apiclient.discovery as googleapi
+import apiclient.errors as googleerrors
+
+from flask_social.providers import ModuleProviderAdapter, cached_profile
+from flask_social.transport import HTTPError, get_transport
+
+try:
+    from oauth2client import crypt as googlecrypt
+except ImportError:
+    googlecrypt = None
 
 config = {
     'id': 'google',
@@ -31,28 +46,149 @@ config = {
     }
 }
 
-def _get_api(credentials):
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    api = googleapi.build('oauth2', 'v2', http=http)
-    return api
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/oauth2/v2/rest'
 
+ID_TOKEN_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
 
-def get_api(connection, **kwargs):
-    credentials = googleoauth.AccessTokenCredentials(
-        access_token=getattr(connection, 'access_token'),
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+
+class _PooledHttp(object):
+    """An :class:`httplib2.Http` compatible client that sends requests through
+    the extension's pooled transport and passes its responses to
+    `response_hook`."""
+
+    def __init__(self, response_hook=None):
+        self.response_hook = response_hook
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        resp = get_transport().request(uri, method=method, body=body,
+                                       headers=headers)
+        if self.response_hook is not None:
+            self.response_hook(resp)
+        info = dict(resp.headers)
+        info['status'] = str(resp.status)
+        return httplib2.Response(info), resp.content
+
+
+_discovery = dict()
+
+_discovery_lock = threading.Lock()
+
+
+def _get_discovery():
+    """Return the parsed discovery document of the OAuth2 API and a service
+    object built from it. Both are created once per process, so API calls do
+    not have to fetch and parse the discovery document first.
+    """
+    try:
+        return _discovery['document'], _discovery['service']
+    except KeyError:
+        pass
+
+    with _discovery_lock:
+        if 'document' not in _discovery:
+            resp, content = _PooledHttp().request(DISCOVERY_URL)
+            if resp.status >= 400:
+                raise googleerrors.HttpError(resp, content, uri=DISCOVERY_URL)
+            document = json.loads(content)
+            _discovery['service'] = googleapi.build_from_document(
+                document, http=_PooledHttp())
+            _discovery['document'] = document
+
+    return _discovery['document'], _discovery['service']
+
+
+_certs = dict(certs={}, fetched=0, expires=0)
+
+_certs_lock = threading.Lock()
+
+
+def _get_certs(kid):
+    """Return Google's id_token signing certificates. They are cached for the
+    max-age of the certificate response and fetched again early when a token
+    is signed with an unknown key, which happens when Google rotates its keys.
+    """
+    now = time.time()
+    if _certs['expires'] > now and kid in _certs['certs']:
+        return _certs['certs']
+
+    with _certs_lock:
+        stale = _certs['expires'] <= now
+        unknown = kid not in _certs['certs'] and _certs['fetched'] < now - 60
+        if stale or unknown:
+            resp = get_transport().request(ID_TOKEN_CERTS_URL)
+            if resp.status >= 400:
+                raise HTTPError(ID_TOKEN_CERTS_URL, resp)
+            cache_control = resp.headers.get('cache-control', '')
+            match = re.search(r'max-age=(\d+)', cache_control)
+            max_age = int(match.group(1)) if match else 3600
+            _certs.update(certs=json.loads(resp.content), fetched=now,
+                          expires=now + max_age)
+
+    return _certs['certs']
+
+
+def _urlsafe_b64decode(value):
+    value = value.encode('ascii')
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def verify_id_token(id_token, audience):
+    """Verify an OpenID Connect id_token locally against Google's cached
+    signing certificates and return its payload, or `None` if the token can
+    not be verified.
+
+    :param id_token: The id_token from the token response
+    :param audience: The client ID the token must be issued to
+    """
+    if googlecrypt is None:
+        return None
+    try:
+        header = json.loads(_urlsafe_b64decode(id_token.split('.')[0]))
+        certs = _get_certs(header.get('kid'))
+        if header.get('kid') in certs:
+            certs = {header['kid']: certs[header['kid']]}
+        payload = googlecrypt.verify_signed_jwt_with_certs(id_token, certs,
+                                                           audience)
+    except (ValueError, TypeError, HTTPError, googlecrypt.AppIdentityError):
+        return None
+    if payload.get('iss') not in ID_TOKEN_ISSUERS:
+        return None
+    return payload
+
+
+def _get_credentials(access_token):
+    return googleoauth.AccessTokenCredentials(
+        access_token=access_token,
         user_agent=''
     )
-    return _get_api(credentials)
+
+
+def _get_api(credentials, response_hook=None):
+    http = _PooledHttp(response_hook)
+    http = credentials.authorize(http)
+    document = _get_discovery()[0]
+    return googleapi.build_from_document(document, http=http)
+
+
+@cached_profile(config['id'])
+def _get_profile(access_token):
+    http = _get_credentials(access_token).authorize(_PooledHttp())
+    service = _get_discovery()[1]
+    return service.userinfo().get().execute(http=http)
+
+
+def get_api(connection, **kwargs):
+    credentials = _get_credentials(getattr(connection, 'access_token'))
+    return _get_api(credentials, kwargs.get('response_hook'))
 
 
 def get_provider_user_id(response, **kwargs):
     if response:
-        credentials = googleoauth.AccessTokenCredentials(
-            access_token=response['access_token'],
-            user_agent=''
-        )
-        profile = _get_api(credentials).userinfo().get().execute()
+        profile = _get_profile(response['access_token'])
         return profile['id']
     return None
 
@@ -62,13 +198,7 @@ def get_connection_values(response, **kwargs):
         return None
 
     access_token = response['access_token']
-
-    credentials = googleoauth.AccessTokenCredentials(
-        access_token=access_token,
-        user_agent=''
-    )
-
-    profile = _get_api(credentials).userinfo().get().execute()
+    profile = _get_profile(access_token)
     return dict(
         provider_id=config['id'],
         provider_user_id=profile['id'],
@@ -86,3 +216,19 @@ def get_token_pair_from_response(response):
         access_token = response.get('access_token', None),
         secret = None
     )
+
+
+class GoogleAdapter(ModuleProviderAdapter):
+    """Reads the user ID from the token response's id_token when there is one
+    so that logins do not need a userinfo request."""
+
+    def get_provider_user_id(self, response):
+        if response and response.get('id_token'):
+            payload = verify_id_token(response['id_token'],
+                                      self.provider.consumer_key)
+            if payload is not None:
+                return payload['sub']
+        return ModuleProviderAdapter.get_provider_user_id(self, response)
+
+
+adapter_class = GoogleAdapter
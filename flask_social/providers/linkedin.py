@@ -1,8 +1,13 @@
 from __future__ import absolute_import
 
+from datetime import datetime
+
 from linkedin import linkedin
 from linkedin.models import AccessToken
 
+from flask_social.providers import cached_profile, report_response
+from flask_social.transport import get_transport
+
 config = {
     'id': 'linkedin',
     'name': 'LinkedIn',
@@ -22,6 +27,20 @@ selectors = ('id', 'first-name', 'last-name', 'email-address',
              'site-standard-profile-request', 'picture-url')
 
 
+class _LinkedInApplication(linkedin.LinkedInApplication):
+    """A :class:`linkedin.LinkedInApplication` passing its responses to
+    `response_hook`."""
+
+    response_hook = None
+
+    def make_request(self, *args, **kwargs):
+        response = linkedin.LinkedInApplication.make_request(self, *args,
+                                                             **kwargs)
+        report_response(self.response_hook, response.status_code,
+                        response.headers)
+        return response
+
+
 def get_api(connection, **kwargs):
     auth = linkedin.LinkedInAuthentication(
         kwargs.get('consumer_key'),
@@ -29,19 +48,28 @@ def get_api(connection, **kwargs):
         None,
         linkedin.PERMISSIONS.enums.values()
     )
-    auth.token = AccessToken(getattr(connection, 'access_token'),
-                             getattr(connection, 'expires_in'))
-    api = linkedin.LinkedInApplication(auth)
+    expires_in = None
+    expires_at = getattr(connection, 'expires_at', None)
+    if expires_at is not None:
+        expires_in = max(int((expires_at - datetime.utcnow()).total_seconds()),
+                         0)
+    auth.token = AccessToken(connection.access_token, expires_in)
+    api = _LinkedInApplication(auth)
+    api.response_hook = kwargs.get('response_hook')
     return api
 
 
+@cached_profile(config['id'])
+def _get_profile(access_token):
+    url = '%sv1/people/~:(%s)' % (config['base_url'], ','.join(selectors))
+    return get_transport().get_json(
+        url, dict(oauth2_access_token=access_token),
+        headers={'x-li-format': 'json'})
+
+
 def get_provider_user_id(response, **kwargs):
     if response:
-        auth = linkedin.LinkedInAuthentication(None, None, None, None)
-        auth.token = AccessToken(response['access_token'], response['expires_in'])
-        api = linkedin.LinkedInApplication(auth)
-
-        profile = api.get_profile(selectors=selectors)
+        profile = _get_profile(response['access_token'])
         return profile['id']
     return None
 
@@ -51,11 +79,7 @@ def get_connection_values(response, **kwargs):
         return None
 
     access_token = response['access_token']
-
-    auth = linkedin.LinkedInAuthentication(None, None, None, None)
-    auth.token = AccessToken(response['access_token'], response['expires_in'])
-    api = linkedin.LinkedInApplication(auth)
-    profile = api.get_profile(selectors=selectors)
+    profile = _get_profile(access_token)
 
     profile_url = profile['siteStandardProfileRequest']['url']
     image_url = profile['pictureUrl']
@@ -73,7 +97,7 @@ def get_connection_values(response, **kwargs):
     )
 
 
-def get_token_pair_from_reponse(response):
+def get_token_pair_from_response(response):
     return dict(
         access_token=response.get('access_token', None),
         secret=None
@@ -11,8 +11,15 @@
 
 from __future__ import absolute_import
 
+import urllib
+
 import twitter
 
+from oauthlib.oauth1 import Client
+
+from flask_social.providers import report_response
+from flask_social.transport import get_transport
+
 config = {
     'id': 'twitter',
     'name': 'Twitter',
@@ -24,12 +31,35 @@ config = {
     'authorize_url': 'https://api.twitter.com/oauth/authenticate'
 }
 
+VERIFY_CREDENTIALS_URL = \
+    'https://api.twitter.com/1.1/account/verify_credentials.json'
+
+USERS_LOOKUP_URL = 'https://api.twitter.com/1.1/users/lookup.json'
+
+#: The maximum number of users in a users/lookup request
+profiles_batch_size = 100
+
+
+class _TwitterApi(twitter.Api):
+    """A :class:`twitter.Api` passing its responses to `response_hook`."""
+
+    response_hook = None
+
+    def _RequestUrl(self, url, verb, data=None):
+        response = twitter.Api._RequestUrl(self, url, verb, data)
+        if response:
+            report_response(self.response_hook, response.status_code,
+                            response.headers)
+        return response
+
 
 def get_api(connection, **kwargs):
-    return twitter.Api(consumer_key=kwargs.get('consumer_key'),
-                       consumer_secret=kwargs.get('consumer_secret'),
-                       access_token_key=connection.access_token,
-                       access_token_secret=connection.secret)
+    api = _TwitterApi(consumer_key=kwargs.get('consumer_key'),
+                      consumer_secret=kwargs.get('consumer_secret'),
+                      access_token_key=connection.access_token,
+                      access_token_secret=connection.secret)
+    api.response_hook = kwargs.get('response_hook')
+    return api
 
 
 def get_provider_user_id(response, **kwargs):
@@ -40,24 +70,45 @@ def get_connection_values(response=None, **kwargs):
     if not response:
         return None
 
-    api = twitter.Api(consumer_key=kwargs.get('consumer_key'),
-                      consumer_secret=kwargs.get('consumer_secret'),
-                      access_token_key=response['oauth_token'],
-                      access_token_secret=response['oauth_token_secret'])
-
-    user = api.VerifyCredentials()
+    client = Client(kwargs.get('consumer_key'),
+                    client_secret=kwargs.get('consumer_secret'),
+                    resource_owner_key=response['oauth_token'],
+                    resource_owner_secret=response['oauth_token_secret'])
+    url, headers, body = client.sign(VERIFY_CREDENTIALS_URL)
+    user = get_transport().get_json(url, headers=headers)
 
-    return dict(
+    rv = dict(
         provider_id=config['id'],
-        provider_user_id=str(user.id),
+        provider_user_id=str(user['id']),
         access_token=response['oauth_token'],
         secret=response['oauth_token_secret'],
-        display_name='@%s' % user.screen_name,
-        full_name = user.name,
-        profile_url="http://twitter.com/%s" % user.screen_name,
-        image_url=user.profile_image_url,
         email='',
     )
+    rv.update(_get_profile_values(user))
+    return rv
+
+
+def _get_profile_values(user):
+    return dict(
+        display_name='@%s' % user['screen_name'],
+        full_name = user['name'],
+        profile_url="http://twitter.com/%s" % user['screen_name'],
+        image_url=user['profile_image_url'],
+    )
+
+
+def get_profiles(connections, **kwargs):
+    """Fetch the profiles of several connections with one users/lookup
+    request signed with the first connection's token."""
+    user_ids = ','.join(str(c.provider_user_id) for c in connections)
+    client = Client(kwargs.get('consumer_key'),
+                    client_secret=kwargs.get('consumer_secret'),
+                    resource_owner_key=connections[0].access_token,
+                    resource_owner_secret=connections[0].secret)
+    url = '%s?%s' % (USERS_LOOKUP_URL, urllib.urlencode(dict(user_id=user_ids)))
+    url, headers, body = client.sign(url)
+    users = get_transport().get_json(url, headers=headers)
+    return dict((str(u['id']), _get_profile_values(u)) for u in users)
 
 def get_token_pair_from_response(response):
     return dict(
@@ -13,6 +13,8 @@ from __future__ import absolute_import
 
 import vkontakte
 
+from flask_social.transport import get_transport
+
 config = {
     'id': 'vk',
     'name': 'VK',
@@ -25,6 +27,12 @@ config = {
 }
 
 
+PROFILE_FIELDS = 'first_name,last_name,photo_100,screen_name'
+
+#: The maximum number of users in a getProfiles request
+profiles_batch_size = 1000
+
+
 def get_api(connection, **kwargs):
     return vkontakte.API(
         api_id=kwargs.get('consumer_key'),
@@ -41,26 +49,45 @@ def get_connection_values(response, **kwargs):
         return None
 
     access_token = response['access_token']
-    vk = vkontakte.API(token=access_token)
-    profile = vk.getProfiles(
-        uids=response['user_id'],
-        fields='first_name,last_name,photo_100,screen_name')[0]
+    rv = get_transport().get_json(
+        config['base_url'] + 'getProfiles',
+        dict(uids=response['user_id'], access_token=access_token,
+             fields=PROFILE_FIELDS))
+    profile = rv['response'][0]
 
-    profile_url = "http://vk.com/id%s" % response['user_id']
-    fullname = u'%s %s' % (profile['first_name'], profile['last_name'])
-    return dict(
+    rv = dict(
         provider_id=config['id'],
         provider_user_id=str(profile['uid']),
         access_token=access_token,
         secret=None,
+        email='',
+    )
+    rv.update(_get_profile_values(profile))
+    return rv
+
+
+def _get_profile_values(profile):
+    fullname = u'%s %s' % (profile['first_name'], profile['last_name'])
+    return dict(
         display_name=profile.get('screen_name', fullname),
         full_name=fullname,
-        profile_url=profile_url,
+        profile_url="http://vk.com/id%s" % profile['uid'],
         image_url=profile.get('photo_100'),
-        email='',
     )
 
 
+def get_profiles(connections, **kwargs):
+    """Fetch the profiles of several connections with one getProfiles
+    request."""
+    rv = get_transport().get_json(
+        config['base_url'] + 'getProfiles',
+        dict(uids=','.join(str(c.provider_user_id) for c in connections),
+             access_token=connections[0].access_token,
+             fields=PROFILE_FIELDS))
+    return dict((str(p['uid']), _get_profile_values(p))
+                for p in rv['response'])
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token=response.get('access_token', None),
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social provider rate limiting
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import threading
+import time
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a provider call can not be made within the caller's
+    timeout without exceeding the provider's rate limit.
+
+    :param provider_id: The provider ID
+    :param retry_after: The number of seconds until a call can be made
+    """
+
+    def __init__(self, provider_id, retry_after):
+        Exception.__init__(self, '%s rate limit exceeded, retry in %.1f '
+                           'seconds' % (provider_id, retry_after))
+        self.provider_id = provider_id
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """A thread safe token bucket allowing `calls` calls per `period` seconds.
+    The bucket refills continuously and is adjusted to the remaining quota
+    reported by the provider with :meth:`update`.
+
+    :param calls: The number of calls allowed per period
+    :param period: The length of the period in seconds
+    """
+
+    def __init__(self, calls, period, timer=time.time, sleep=time.sleep):
+        self.calls = calls
+        self.period = period
+        self._rate = float(calls) / period
+        self._tokens = float(calls)
+        self._blocked_until = 0
+        self._timer = timer
+        self._sleep = sleep
+        self._updated = timer()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self.calls, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    def _wait_time(self, now):
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def try_acquire(self):
+        """Take a token if one is available. Returns `0` on success or the
+        number of seconds until a token will be available."""
+        with self._lock:
+            now = self._timer()
+            self._refill(now)
+            wait = self._wait_time(now)
+            if not wait:
+                self._tokens -= 1
+            return wait
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting for one to become available. Returns `0` on
+        success or, when no token becomes available within `timeout` seconds,
+        the number of seconds until one will be.
+
+        :param timeout: The number of seconds to wait. `None` waits as long as
+                        necessary and `0` does not wait.
+        """
+        deadline = None if timeout is None else self._timer() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return 0
+            if deadline is not None and self._timer() + wait > deadline:
+                return wait
+            self._sleep(wait)
+
+    def update(self, remaining, reset=None):
+        """Adjust the bucket to the quota reported by the provider.
+
+        :param remaining: The number of calls the provider still allows
+        :param reset: The time the provider's quota resets, in seconds since
+                      the epoch
+        """
+        with self._lock:
+            now = self._timer()
+            self._refill(now)
+            self._tokens = min(self._tokens, max(remaining, 0))
+            if remaining <= 0 and reset is not None and reset > now:
+                self._blocked_until = reset
+
+    def quota(self):
+        """Return the number of calls currently `remaining`, the `limit` per
+        `period` and the number of seconds until the next call is allowed."""
+        with self._lock:
+            now = self._timer()
+            self._refill(now)
+            return dict(remaining=int(self._tokens), limit=self.calls,
+                        period=self.period, wait=self._wait_time(now))
+
+
+def parse_rate_limit_headers(headers, limit):
+    """Return the remaining quota and reset time reported by a provider
+    response or `None` when the response has no rate limit headers. Twitter's
+    and the common `X-RateLimit-*` headers are read, as well as Facebook's
+    `X-App-Usage` percentages.
+
+    :param headers: A dictionary of lower case response headers
+    :param limit: The configured number of calls per period, used to convert
+                  usage percentages into a remaining quota
+    """
+    for prefix in ('x-rate-limit-', 'x-ratelimit-'):
+        remaining = headers.get(prefix + 'remaining')
+        if remaining is not None:
+            reset = headers.get(prefix + 'reset')
+            try:
+                return int(remaining), int(reset) if reset else None
+            except ValueError:
+                return None
+
+    usage = headers.get('x-app-usage')
+    if usage is not None:
+        try:
+            usage = json.loads(usage)
+            percent = max(int(v) for v in usage.values())
+        except (ValueError, TypeError, AttributeError):
+            return None
+        return int(limit * max(100 - percent, 0) / 100), None
+    return None
+
+
+class RateLimitedAPI(object):
+    """A proxy of a provider API client that takes a token from the provider's
+    bucket before every method call of the client.
+
+    :param api: The API client
+    :param provider_id: The provider ID
+    :param bucket: The provider's :class:`TokenBucket`
+    :param timeout: The number of seconds a call waits for the rate limit.
+                    `None` waits as long as necessary and `0` fails fast.
+    """
+
+    def __init__(self, api, provider_id, bucket, timeout=None):
+        self.__dict__.update(_api=api, _provider_id=provider_id,
+                             _bucket=bucket, _timeout=timeout)
+
+    def __getattr__(self, name):
+        value = getattr(self._api, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            wait = self._bucket.acquire(self._timeout)
+            if wait:
+                raise RateLimitExceeded(self._provider_id, wait)
+            return value(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._api, name, value)
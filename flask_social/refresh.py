@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.refresh
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social maintenance jobs
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import heapq
+import threading
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import count, islice
+from Queue import Queue, Empty
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+_social = LocalProxy(lambda: current_app.extensions['social'])
+
+_datastore = LocalProxy(lambda: _social.datastore)
+
+_logger = LocalProxy(lambda: current_app.logger)
+
+PROFILE_FIELDS = ('display_name', 'full_name', 'profile_url', 'image_url')
+
+#: The values of a connection passed to a provider's `get_profiles`. Worker
+#: threads are only given these copies, never the datastore's connections,
+#: which belong to the thread that loaded them.
+ProfileConnection = namedtuple('ProfileConnection',
+                               ('pk', 'provider_user_id', 'access_token',
+                                'secret') + PROFILE_FIELDS)
+
+
+def _copy_for_profiles(connection):
+    return ProfileConnection(
+        _datastore._get_pk(connection), connection.provider_user_id,
+        connection.access_token, getattr(connection, 'secret', None),
+        *[getattr(connection, field, None) for field in PROFILE_FIELDS])
+
+
+def _chunks(iterable, size):
+    # Peewee result wrappers restart when iter() is called on them again
+    iterator = (item for item in iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _fetch_profiles(app, jobs, results):
+    with app.app_context():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            provider, chunk = job
+            try:
+                profiles = provider.adapter.get_profiles(chunk)
+            except Exception as e:
+                profiles = e
+            results.put((provider, chunk, profiles))
+
+
+def refresh_profiles(provider_ids=None, concurrency=4, batch_size=500):
+    """Update the stored profile values of every connection to the specified
+    providers using the providers' bulk profile endpoints. Connections are
+    read from the datastore one batch at a time and copied before they are
+    handed to the worker threads, and at most `concurrency` batches are
+    fetched from the providers at once, so memory use does not depend on the
+    number of connections. Changed values are written by primary key and
+    committed in batches of `batch_size`. Returns a dictionary of counters per
+    provider.
+
+    :param provider_ids: The providers to refresh, defaults to all configured
+                         providers with a bulk profile endpoint
+    :param concurrency: The number of concurrent provider requests
+    :param batch_size: The number of changed connections per commit
+    """
+    providers = [_social.providers[provider_id]
+                 for provider_id in provider_ids or _social.providers]
+    providers = [p for p in providers if p.adapter.profiles_batch_size]
+
+    stats = dict((p.id, dict(checked=0, updated=0, failed=0))
+                 for p in providers)
+    jobs = Queue(maxsize=concurrency)
+    results = Queue()
+    pending = {}
+    model = _datastore.connection_model
+    fields = [field for field in PROFILE_FIELDS if hasattr(model, field)]
+    loaded = ('provider_user_id', 'access_token') + tuple(
+        field for field in ('secret',) + PROFILE_FIELDS
+        if hasattr(model, field))
+
+    def write_pending():
+        _datastore.update_connections(pending)
+        pending.clear()
+
+    def apply_results():
+        while True:
+            try:
+                provider, chunk, profiles = results.get_nowait()
+            except Empty:
+                return
+            counters = stats[provider.id]
+            counters['checked'] += len(chunk)
+            if isinstance(profiles, Exception):
+                _logger.warning('Failed to refresh %d %s profiles: %s' %
+                                (len(chunk), provider.name, profiles))
+                counters['failed'] += len(chunk)
+                continue
+            for connection in chunk:
+                values = profiles.get(str(connection.provider_user_id))
+                if values is None:
+                    counters['failed'] += 1
+                    continue
+                changed = dict((field, values.get(field))
+                               for field in fields
+                               if getattr(connection, field) !=
+                               values.get(field))
+                if changed:
+                    pending[connection.pk] = changed
+                    counters['updated'] += 1
+            if len(pending) >= batch_size:
+                write_pending()
+
+    app = current_app._get_current_object()
+    workers = [threading.Thread(target=_fetch_profiles,
+                                args=(app, jobs, results))
+               for i in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    try:
+        for provider in providers:
+            connections = _datastore.find_connections(fields=loaded,
+                                                      provider_id=provider.id)
+            for chunk in _chunks(connections,
+                                 provider.adapter.profiles_batch_size):
+                jobs.put((provider, [_copy_for_profiles(connection)
+                                     for connection in chunk]))
+                apply_results()
+    finally:
+        for worker in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+    apply_results()
+    if pending:
+        write_pending()
+    return stats
+
+
+def _expiring(provider, deadline, counter):
+    # The counter orders connections expiring at the same time, so that they
+    # are never compared
+    connections = _datastore.find_expiring_connections(
+        deadline, provider_id=provider.id)
+    for connection in connections:
+        yield connection.expires_at, next(counter), provider, connection
+
+
+def refresh_tokens(provider_ids=None, within=3600, batch_size=500):
+    """Refresh the access tokens of all connections that expire within
+    `within` seconds and have a refresh token. Only those connections are
+    loaded from the datastore, one chunk at a time in order of expiry, and
+    the providers' connections are merged so that the tokens closest to
+    expiring are refreshed first, before a slow provider runs the job out of
+    time. Refreshed connections are committed in batches of `batch_size`.
+    Returns a dictionary of counters per provider.
+
+    :param provider_ids: The providers to refresh, defaults to all configured
+                         OAuth 2 providers
+    :param within: The number of seconds before expiry a token is refreshed
+    :param batch_size: The number of refreshed connections per commit
+    """
+    providers = [_social.providers[provider_id]
+                 for provider_id in provider_ids or _social.providers]
+    providers = [p for p in providers if not p.request_token_url]
+    deadline = datetime.utcnow() + timedelta(seconds=within)
+
+    stats = dict((p.id, dict(expiring=0, refreshed=0, failed=0))
+                 for p in providers)
+    # Connections whose refreshed token still expires before the deadline are
+    # read again further on
+    refreshed = set()
+    pending = 0
+    counter = count()
+    for expires_at, _, provider, connection in heapq.merge(
+            *[_expiring(provider, deadline, counter)
+              for provider in providers]):
+        key = (provider.id, _datastore._get_pk(connection))
+        if key in refreshed:
+            continue
+        stats[provider.id]['expiring'] += 1
+        if provider.refresh_access_token(connection):
+            stats[provider.id]['refreshed'] += 1
+            pending += 1
+            if connection.expires_at and connection.expires_at <= deadline:
+                refreshed.add(key)
+        else:
+            stats[provider.id]['failed'] += 1
+        if pending >= batch_size:
+            _datastore.commit()
+            pending = 0
+
+    if pending:
+        _datastore.commit()
+    return stats
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.transport
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social HTTP transport
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import base64
+import httplib
+import json
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from contextlib import contextmanager
+
+from flask import current_app
+
+#: Response statuses of idempotent requests that are retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+#: Methods that are sent again when a reused connection turns out to be closed
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+_policy = threading.local()
+
+
+class HTTPError(Exception):
+    """Raised when a provider responds with an error status.
+
+    :param response: The :class:`HTTPResponse`
+    """
+
+    def __init__(self, url, response):
+        Exception.__init__(self, 'HTTP %s from %s' % (response.status, url))
+        self.url = url
+        self.response = response
+
+
+@contextmanager
+def request_policy(timeout=None, retries=0, backoff=0.2):
+    """Apply a deadline and a retry limit to every request the current thread
+    sends through a :class:`HTTPTransport` within the block. Requests fail
+    with :class:`socket.timeout` once the deadline has passed and the socket
+    timeout of each request is limited to the time left.
+
+    :param timeout: The number of seconds the block may spend on requests.
+                    `None` leaves requests to the transport's timeout.
+    :param retries: The number of times a failed GET request is retried
+    :param backoff: The base delay in seconds before the first retry. The
+                    delay doubles with each retry and is jittered.
+    """
+    previous = getattr(_policy, 'current', None)
+    deadline = None if timeout is None else time.time() + timeout
+    _policy.current = (deadline, retries, backoff)
+    try:
+        yield
+    finally:
+        _policy.current = previous
+
+
+class HTTPResponse(object):
+    """A response read by :class:`HTTPTransport`. Header names are lower
+    case."""
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    @property
+    def code(self):
+        return self.status
+
+
+class HTTPTransport(object):
+    """A thread safe HTTP client that keeps connections to each host alive and
+    reuses them across requests. Requests are sent through the proxies
+    configured by the `http_proxy` and `https_proxy` environment variables,
+    except to the hosts listed in `no_proxy`. HTTPS requests are tunneled
+    through the proxy.
+
+    :param pool_size: The maximum number of idle connections kept per host
+    :param timeout: The default socket timeout in seconds
+    :param proxies: A dictionary of proxy URLs by scheme, defaults to the
+                    proxies of the environment
+    """
+
+    #: The fraction of a retry earned by each request. Retries are only made
+    #: while earned retries are left, so that retries can not multiply the
+    #: load on a provider that is failing every request.
+    retry_ratio = 0.2
+
+    #: The maximum number of earned retries
+    max_retries = 10
+
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection
+    }
+
+    def __init__(self, pool_size=10, timeout=10, proxies=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self._pools = {}
+        self._observers = {}
+        self._lock = threading.Lock()
+        self._retry_budget = float(self.max_retries)
+        self._stats = dict(requests=0, connections=0, reused=0, discarded=0,
+                           retries=0)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _earn_retry(self):
+        with self._lock:
+            self._retry_budget = min(self._retry_budget + self.retry_ratio,
+                                     self.max_retries)
+
+    def _spend_retry(self):
+        with self._lock:
+            if self._retry_budget < 1:
+                return False
+            self._retry_budget -= 1
+            self._stats['retries'] += 1
+            return True
+
+    def _acquire(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                self._stats['reused'] += 1
+                return pool.pop(), True
+            self._stats['connections'] += 1
+        scheme, host, port, proxy = key
+        if proxy is None:
+            return self.connection_classes[scheme](host, port), False
+        proxy_host, proxy_port, authorization = proxy
+        if scheme == 'http':
+            return httplib.HTTPConnection(proxy_host, proxy_port), False
+        conn = httplib.HTTPSConnection(proxy_host, proxy_port)
+        headers = {}
+        if authorization:
+            headers['Proxy-Authorization'] = authorization
+        conn.set_tunnel(host, port, headers)
+        return conn, False
+
+    def _get_proxy(self, scheme, host):
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        authorization = None
+        if parts.username:
+            authorization = 'Basic ' + base64.b64encode('%s:%s' % (
+                urllib.unquote(parts.username),
+                urllib.unquote(parts.password or '')))
+        return parts.hostname, parts.port or 80, authorization
+
+    def _release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+            self._stats['discarded'] += 1
+        conn.close()
+
+    def _send(self, conn, method, path, body, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request(method, path, body, headers)
+        resp = conn.getresponse()
+        content = resp.read()
+        headers = dict((k.lower(), v) for k, v in resp.getheaders())
+        return resp, HTTPResponse(resp.status, headers, content)
+
+    def request(self, url, method='GET', body=None, headers=None,
+                timeout=None):
+        """Send a request and return an :class:`HTTPResponse`. Within a
+        :func:`request_policy` block a failed GET request is retried with a
+        jittered backoff and the timeout is limited by the block's deadline.
+
+        :param url: The absolute URL
+        :param method: The HTTP method
+        :param body: The request body
+        :param headers: A dictionary of request headers
+        :param timeout: The socket timeout, defaults to the transport's timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline, retries, backoff = (getattr(_policy, 'current', None) or
+                                      (None, 0, 0))
+        if method.upper() not in ('GET', 'HEAD'):
+            retries = 0
+        self._earn_retry()
+
+        attempt = 0
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('Deadline exceeded for %s' % url)
+                timeout = min(timeout, remaining)
+            try:
+                response = self._request(url, method, body, headers, timeout)
+            except (httplib.HTTPException, socket.error):
+                if attempt >= retries or not self._spend_retry():
+                    raise
+            else:
+                if (response.status not in RETRY_STATUSES or
+                        attempt >= retries or not self._spend_retry()):
+                    return response
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if deadline is not None:
+                delay = min(delay, max(deadline - time.time(), 0))
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, url, method, body, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        proxy = self._get_proxy(scheme, parts.hostname)
+        key = (scheme, parts.hostname, port, proxy)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(headers or {})
+        if proxy is not None and scheme == 'http':
+            # Plain requests are sent to the proxy with the absolute URL
+            path = '%s://%s%s' % (scheme, parts.netloc, path)
+            if proxy[2]:
+                headers['Proxy-Authorization'] = proxy[2]
+        self._count('requests')
+
+        conn, reused = self._acquire(key)
+        try:
+            resp, response = self._send(conn, method, path, body,
+                                        dict(headers), timeout)
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # The server might have closed an idle connection, retry on a new
+            # one unless the request might have been processed
+            if not reused or method.upper() not in IDEMPOTENT_METHODS:
+                raise
+            conn, reused = self._acquire(key)
+            try:
+                resp, response = self._send(conn, method, path, body,
+                                            dict(headers), timeout)
+            except Exception:
+                conn.close()
+                raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        for callback in self._observers.get(parts.hostname, ()):
+            callback(response)
+        return response
+
+    def observe(self, host, callback):
+        """Call `callback` with every :class:`HTTPResponse` received from
+        the specified host.
+
+        :param host: The host name
+        :param callback: A function accepting the response
+        """
+        with self._lock:
+            self._observers.setdefault(host, []).append(callback)
+
+    def get_json(self, url, params=None, headers=None, timeout=None):
+        """Send a GET request and return the decoded JSON response body.
+        Raises :class:`HTTPError` if the response status is 400 or above.
+
+        :param url: The absolute URL
+        :param params: A dictionary of query string parameters
+        """
+        if params:
+            url += ('&' if '?' in url else '?') + urllib.urlencode(params)
+        response = self.request(url, headers=headers, timeout=timeout)
+        if response.status >= 400:
+            raise HTTPError(url, response)
+        return json.loads(response.content)
+
+    def stats(self):
+        """Return the request and connection counters of the transport and
+        the number of idle connections per host."""
+        with self._lock:
+            rv = dict(self._stats)
+            rv['idle'] = dict(('%s://%s:%s' % key[:3], len(pool))
+                              for key, pool in self._pools.items())
+        return rv
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+
+_default_transport = HTTPTransport()
+
+
+def get_transport():
+    """Return the transport of the current application's Social extension, or
+    a process wide default transport when there is no application context."""
+    try:
+        return current_app.extensions['social'].transport
+    except (RuntimeError, KeyError, AttributeError):
+        return _default_transport
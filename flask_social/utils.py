@@ -10,9 +10,10 @@
 """
 import collections
 
-from importlib import import_module
+from datetime import datetime, timedelta
 
-from flask import current_app, url_for, request, abort
+from flask import current_app, url_for, request, abort, g
+from flask.ext.security import current_user
 
 
 def get_provider_or_404(provider_id):
@@ -37,20 +38,89 @@ def get_authorize_callback(endpoint, provider_id):
     return request.url_root[:-1] + url
 
 
+def get_connection_map():
+    """Return the current user's connections grouped by provider ID. The
+    connections are loaded with a single query the first time they are needed
+    and kept on :data:`flask.g` for the rest of the request. Values waiting in
+    the write-behind queue are applied to the connections.
+    """
+    user_id = current_user.get_id()
+    cached = getattr(g, '_social_connections', None)
+    if cached is not None and cached[0] == user_id:
+        return cached[1]
+
+    state = current_app.extensions['social']
+    datastore, queue = state.datastore, state.token_queue
+    connections = {}
+    for connection in datastore.find_connections(user_id=current_user.id):
+        if queue is not None:
+            queue.apply(connection)
+        connections.setdefault(connection.provider_id, []).append(connection)
+
+    g._social_connections = (user_id, connections)
+    return connections
+
+
+def clear_connection_map():
+    """Discard the current user's connections loaded during this request."""
+    g._social_connections = None
+
+
+def get_current_connection(provider_id):
+    """Return the current user's connection to the specified provider or
+    `None` if there is no connection.
+
+    :param provider_id: The provider ID
+    """
+    connections = get_connection_map().get(provider_id)
+    return connections[0] if connections else None
+
+
 def get_connection_values_from_oauth_response(provider, oauth_response):
     if oauth_response is None:
         return None
 
-    module = import_module(provider.module)
-
-    return module.get_connection_values(
-        oauth_response,
-        consumer_key=provider.consumer_key,
-        consumer_secret=provider.consumer_secret)
+    return provider.adapter.get_connection_values(oauth_response)
 
 def get_token_pair_from_oauth_response(provider, oauth_response):
-    module = import_module(provider.module)
-    return module.get_token_pair_from_response(oauth_response)
+    return provider.adapter.get_token_pair(oauth_response)
+
+
+def get_token_values(oauth_response):
+    """Return the `refresh_token` and the absolute `expires_at` time, in
+    UTC, of an OAuth 2 token response. Either value is `None` when the
+    provider did not send it.
+
+    :param oauth_response: The token response
+    """
+    expires_in = oauth_response.get('expires_in',
+                                    oauth_response.get('expires'))
+    expires_at = None
+    if expires_in:
+        expires_at = datetime.utcnow() + timedelta(seconds=int(expires_in))
+    return dict(refresh_token=oauth_response.get('refresh_token'),
+                expires_at=expires_at)
+
+
+def get_token_values_from_oauth_response(provider, oauth_response):
+    """Return the token values to store with a connection, or an empty
+    dictionary if the connection model has no `refresh_token` and
+    `expires_at` fields or the provider uses OAuth 1."""
+    model = current_app.extensions['social'].datastore.connection_model
+    if (oauth_response is None or provider.request_token_url or
+            not hasattr(model, 'refresh_token') or
+            not hasattr(model, 'expires_at')):
+        return {}
+    return get_token_values(oauth_response)
+
+
+def token_expires_soon(connection, margin):
+    """Return `True` if the access token of the specified connection can be
+    refreshed and expires within `margin` seconds."""
+    expires_at = getattr(connection, 'expires_at', None)
+    if expires_at is None or not getattr(connection, 'refresh_token', None):
+        return False
+    return expires_at <= datetime.utcnow() + timedelta(seconds=margin)
 
 def get_config(app):
     """Conveniently get the social configuration for the specified
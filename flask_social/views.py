@@ -8,21 +8,22 @@
     :copyright: (c) 2012 by Matt Wright.
     :license: MIT, see LICENSE for more details.
 """
-from importlib import import_module
-
 from flask import (Blueprint, current_app, redirect, request, session,
-                   after_this_request, abort, url_for)
+                   after_this_request, url_for)
 from flask.ext.security import current_user, login_required
 from flask.ext.security.utils import (get_post_login_redirect, login_user,
                                       logout_user, get_url, do_flash)
 from flask.ext.security.decorators import anonymous_user_required
 from werkzeug.local import LocalProxy
 
+from .circuit import ProviderUnavailable
 from .signals import (connection_removed, connection_created,
                       connection_failed, login_completed, login_failed)
 from .utils import (config_value, get_provider_or_404, get_authorize_callback,
                     get_connection_values_from_oauth_response,
-                    get_token_pair_from_oauth_response)
+                    get_token_pair_from_oauth_response,
+                    get_token_values_from_oauth_response,
+                    clear_connection_map, get_current_connection)
 
 
 # Convenient references
@@ -40,6 +41,13 @@ def _commit(response=None):
     return response
 
 
+def _record_removed(count):
+    # Called directly rather than through connection_removed, whose receivers
+    # decide whether removed connections are loaded
+    if _social.identity_filter is not None:
+        _social.identity_filter.record_removed(count)
+
+
 @anonymous_user_required
 def login(provider_id):
     """Starts the provider login OAuth flow"""
@@ -63,9 +71,18 @@ def connect(provider_id):
 
 @login_required
 def reconnect(provider_id):
-    """Tokens automatically refresh with login.
-    Logs user out and starts provider login OAuth flow
+    """Refreshes the token of the current user's connection in place when
+    the connection has a refresh token. Otherwise tokens refresh with login,
+    so the user is logged out and the provider login OAuth flow is started.
     """
+    provider = get_provider_or_404(provider_id)
+    connection = get_current_connection(provider_id)
+    if connection is not None and provider.refresh_access_token(connection):
+        after_this_request(_commit)
+        do_flash('Connection to %s refreshed' % provider.name, 'success')
+        return redirect(request.referrer or
+                        get_url(config_value('CONNECT_ALLOW_VIEW')))
+
     logout_user()
     return login(provider_id)
 
@@ -78,14 +95,24 @@ def remove_all_connections(provider_id):
 
     ctx = dict(provider=provider.name, user=current_user)
 
-    deleted = _datastore.delete_connections(user_id=current_user.get_id(),
-                                            provider_id=provider_id)
+    query = dict(user_id=current_user.get_id(), provider_id=provider_id)
+    # The connections are only loaded when receivers want each of them
+    connections = None
+    if connection_removed.receivers:
+        connections = list(_datastore.find_connections(**query))
+
+    deleted = _datastore.delete_connections(**query)
     if deleted:
         after_this_request(_commit)
+        provider.invalidate_api(current_user.get_id())
+        clear_connection_map()
+        _record_removed(deleted)
         msg = ('All connections to %s removed' % provider.name, 'info')
-        connection_removed.send(current_app._get_current_object(),
-                                user=current_user._get_current_object(),
-                                provider_id=provider_id)
+        for connection in connections or ():
+            connection_removed.send(current_app._get_current_object(),
+                                    user=current_user._get_current_object(),
+                                    provider_id=provider_id,
+                                    connection=connection)
     else:
         msg = ('Unable to remove connection to %(provider)s' % ctx, 'error')
 
@@ -109,6 +136,9 @@ def remove_connection(provider_id, provider_user_id):
 
     if deleted:
         after_this_request(_commit)
+        provider.invalidate_api(current_user.get_id())
+        clear_connection_map()
+        _record_removed(1)
         msg = ('Connection to %(provider)s removed' % ctx, 'info')
         connection_removed.send(current_app._get_current_object(),
                                 user=current_user._get_current_object(),
@@ -127,12 +157,11 @@ def connect_handler(cv, provider):
     :param provider_id: The provider ID the connection shoudl be made to
     """
     cv.setdefault('user_id', current_user.get_id())
-    connection = _datastore.find_connection(
-        provider_id=cv['provider_id'], provider_user_id=cv['provider_user_id'])
+    connection = _datastore.upsert_connection(**cv)
 
-    if connection is None:
+    if connection is not None:
         after_this_request(_commit)
-        connection = _datastore.create_connection(**cv)
+        clear_connection_map()
         msg = ('Connection established to %s' % provider.name, 'success')
         connection_created.send(current_app._get_current_object(),
                                 user=current_user._get_current_object(),
@@ -155,9 +184,22 @@ def connect_callback(provider_id):
 
     def connect(response):
         cv = get_connection_values_from_oauth_response(provider, response)
+        if cv is not None:
+            cv.update(get_token_values_from_oauth_response(provider,
+                                                           response))
         return cv
 
-    cv = provider.authorized_handler(connect)()
+    try:
+        with provider.protect():
+            cv = provider.authorized_handler(connect)()
+    except ProviderUnavailable as e:
+        _logger.warning(e)
+        connection_failed.send(current_app._get_current_object(),
+                               user=current_user._get_current_object())
+        do_flash('%s is currently unavailable, please try again '
+                 'later' % provider.name, 'error')
+        return redirect(get_url(config_value('CONNECT_DENY_VIEW')))
+
     if cv is None:
         do_flash('Access was denied by %s' % provider.name, 'error')
         return redirect(get_url(config_value('CONNECT_DENY_VIEW')))
@@ -169,17 +211,30 @@ def connect_callback(provider_id):
 def login_handler(response, provider, query):
     """Shared method to handle the signin process"""
 
-    connection = _datastore.find_connection(**query)
+    identities = _social.identity_filter
+    if identities is not None and not identities.might_exist(**query):
+        connection, user = None, None
+    else:
+        connection, user = _datastore.login_lookup(**query)
 
     if connection:
         after_this_request(_commit)
-        token_pair = get_token_pair_from_oauth_response(provider, response)
-        if (token_pair['access_token'] != connection.access_token or
-            token_pair['secret'] != connection.secret):
-            connection.access_token = token_pair['access_token']
-            connection.secret = token_pair['secret']
-            _datastore.put(connection)
-        user = connection.user
+        queue = _social.token_queue
+        if queue is not None:
+            queue.apply(connection)
+        values = get_token_pair_from_oauth_response(provider, response)
+        if (values['access_token'] != connection.access_token or
+            values['secret'] != connection.secret):
+            provider.invalidate_api(user.get_id())
+        token_values = get_token_values_from_oauth_response(provider, response)
+        if token_values:
+            if token_values['refresh_token'] is None:
+                token_values.pop('refresh_token')
+            values.update(token_values)
+        if queue is not None:
+            queue.put(connection, **values)
+        else:
+            _datastore.update_connection(connection, **values)
         login_user(user)
         key = _social.post_oauth_login_session_key
         redirect_url = session.pop(key, get_post_login_redirect())
@@ -200,11 +255,7 @@ def login_handler(response, provider, query):
 
 
 def login_callback(provider_id):
-    try:
-        provider = _social.providers[provider_id]
-        module = import_module(provider.module)
-    except KeyError:
-        abort(404)
+    provider = get_provider_or_404(provider_id)
 
     def login(response):
         _logger.debug('Received login response from '
@@ -215,22 +266,44 @@ def login_callback(provider_id):
                      'account' % provider.name, 'error')
             return _security.login_manager.unauthorized(), None
 
-        query = dict(provider_user_id=module.get_provider_user_id(response),
+        provider_user_id = provider.adapter.get_provider_user_id(response)
+        query = dict(provider_user_id=provider_user_id,
                      provider_id=provider_id)
 
         return response, query
 
-    response, query = provider.authorized_handler(login)()
+    try:
+        with provider.protect():
+            response, query = provider.authorized_handler(login)()
+    except ProviderUnavailable as e:
+        _logger.warning(e)
+        login_failed.send(current_app._get_current_object(),
+                          provider=provider, oauth_response=None)
+        do_flash('%s is currently unavailable, please try again '
+                 'later' % provider.name, 'error')
+        return redirect(get_url(_security.login_manager.login_view))
+
     if query is None:
         return response
     return login_handler(response, provider, query)
 
 
+def social_connection(provider_id):
+    """Template helper returning the current user's connection to the
+    specified provider or `None`."""
+    if not current_user.is_authenticated():
+        return None
+    return get_current_connection(provider_id)
+
+
 def create_blueprint(state, import_name):
     bp = Blueprint(state.blueprint_name, import_name,
                    url_prefix=state.url_prefix,
                    template_folder='templates')
 
+    bp.app_context_processor(
+        lambda: dict(social_connection=social_connection))
+
     bp.route('/login/<provider_id>')(login_callback)
 
     bp.route('/login/<provider_id>',
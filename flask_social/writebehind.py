@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.writebehind
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social write-behind queue
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+
+
+class WriteBehindQueue(object):
+    """A thread safe queue of connection values to be written by a background
+    thread. Values queued for the same connection are merged, so only the
+    last value of each field is written, and pending values are written every
+    `interval` seconds in transactions of up to `batch_size` connections.
+
+    :param datastore: The connection datastore
+    :param interval: The number of seconds between writes
+    :param batch_size: The number of connections written per transaction
+    """
+
+    def __init__(self, datastore, interval=1, batch_size=500):
+        self.datastore = datastore
+        self.interval = interval
+        self.batch_size = batch_size
+        self.writes = 0
+        self.failures = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, connection, **values):
+        """Queue the values that differ from the values of a connection to be
+        written and set them on the connection. Returns `True` if any value
+        changed."""
+        changed = dict((key, value) for key, value in values.items()
+                       if getattr(connection, key) != value)
+        if not changed:
+            return False
+        pk = self.datastore._get_pk(connection)
+        with self._lock:
+            self._pending.setdefault(pk, {}).update(changed)
+        self.datastore._set_loaded_values(connection, changed)
+        return True
+
+    def get(self, connection):
+        """Return the values queued for a connection that have not been
+        written yet."""
+        pk = self.datastore._get_pk(connection)
+        with self._lock:
+            return dict(self._pending.get(pk, {}))
+
+    def apply(self, connection):
+        """Set the values queued for a connection on the connection as if they
+        had been loaded from the datastore."""
+        values = self.get(connection)
+        if values:
+            self.datastore._set_loaded_values(connection, values)
+        return connection
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, logger=None):
+        """Write all pending values. When a batch fails to be written, it and
+        the remaining batches are queued again, keeping any newer values
+        queued meanwhile. Must be called within an application context."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            items = pending.items()
+            for i in range(0, len(items), self.batch_size):
+                batch = dict(items[i:i + self.batch_size])
+                try:
+                    self.datastore.update_connections(batch)
+                except Exception as e:
+                    self.failures += len(batch)
+                    if logger is not None:
+                        logger.warning('Failed to write %d connections: %s' %
+                                       (len(batch), e))
+                    with self._lock:
+                        for pk, values in items[i:]:
+                            values.update(self._pending.get(pk, {}))
+                            self._pending[pk] = values
+                    return
+                self.writes += len(batch)
+
+    def _run(self, app):
+        while not self._stopped.wait(self.interval):
+            if len(self):
+                with app.app_context():
+                    self.flush(app.logger)
+
+    def start(self, app):
+        """Start writing pending values in a background thread.
+
+        :param app: The Flask application
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(app,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, app):
+        """Stop the background thread and write all pending values.
+
+        :param app: The Flask application
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with app.app_context():
+            self.flush(app.logger)
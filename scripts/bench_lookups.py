@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-lookups
+    ~~~~~~~~~~~~~
+
+    Measures the rate of login lookups of a connection by provider user,
+    loading only the login fields, against a file backed SQLite database
+    through each of these datastores:
+
+    * ``sqlalchemy``: ``SQLAlchemyConnectionDatastore`` with Flask-SQLAlchemy
+    * ``sqlite``: ``SQLiteConnectionDatastore``
+
+    The query plan of the ``sqlite`` lookup is printed to check that it is
+    answered from the login index alone.
+
+    Usage::
+
+        $ python scripts/bench_lookups.py [connections] [lookups]
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import Flask
+from flask.ext.sqlalchemy import SQLAlchemy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask_social.datastore import LOGIN_FIELDS, \
+    SQLAlchemyConnectionDatastore, SQLiteConnectionDatastore
+from flask_social.models import SQLAlchemyConnectionMixin
+
+
+def create_datastores(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(
+        path, 'sqlalchemy.db')
+    db = SQLAlchemy(app)
+
+    class User(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    class Connection(db.Model, SQLAlchemyConnectionMixin):
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+        user = db.relationship(User)
+
+    sqlite = SQLiteConnectionDatastore(os.path.join(path, 'sqlite.db'))
+    sqlite.init_app(app)
+    return app, db, User, [
+        ('sqlalchemy', SQLAlchemyConnectionDatastore(db, Connection)),
+        ('sqlite', sqlite)]
+
+
+def fill(db, user_model, datastores, connections):
+    db.create_all()
+    db.session.add(user_model(id=1))
+    for name, datastore in datastores:
+        for i in range(connections):
+            datastore.create_connection(
+                user_id=1, provider_id='twitter', provider_user_id=str(i),
+                access_token='token%d' % i, secret='secret')
+        datastore.commit()
+
+
+def run_lookups(name, datastore, db, connections, lookups):
+    start = time.time()
+    for i in range(lookups):
+        connection = datastore.find_connection(
+            fields=LOGIN_FIELDS, provider_id='twitter',
+            provider_user_id=str(i * 7 % connections))
+        assert connection.access_token
+        if name == 'sqlalchemy':
+            # Each login runs in a new session
+            db.session.expunge_all()
+    elapsed = time.time() - start
+    print('%-10s %10.0f lookups/s %8.1f us/lookup' % (
+        name, lookups / elapsed, elapsed * 1e6 / lookups))
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    path = tempfile.mkdtemp()
+    try:
+        app, db, user_model, datastores = create_datastores(path)
+        with app.app_context():
+            fill(db, user_model, datastores, connections)
+            sqlite = dict(datastores)['sqlite']
+            statement = sqlite._query(LOGIN_FIELDS, provider_id='twitter',
+                                      provider_user_id='0')[0]['one']
+            for row in sqlite.db.execute('EXPLAIN QUERY PLAN ' + statement,
+                                         ['twitter', '0']):
+                print('plan: %s' % row[-1])
+            print('%d connections, %d lookups of %s' % (
+                connections, lookups, ', '.join(LOGIN_FIELDS)))
+            for name, datastore in datastores:
+                run_lookups(name, datastore, db, connections, lookups)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-providers
+    ~~~~~~~~~~~~~~~
+
+    Measures the cold start time and resident memory of an application with
+    all of the bundled providers configured. Each scenario runs in a fresh
+    interpreter so that previously imported modules do not skew the numbers:
+
+    * ``init``: ``Social.init_app`` only, provider modules are not loaded
+    * ``loaded``: ``Social.init_app`` and every provider accessed once
+
+    Usage::
+
+        $ python scripts/bench_providers.py [runs]
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+import json
+import os
+import subprocess
+import sys
+
+PROVIDERS = ('facebook', 'foursquare', 'google', 'linkedin', 'twitter', 'vk')
+
+SCENARIO = """
+import json, resource, sys, time
+start = time.time()
+from flask import Flask
+from flask_social import Social
+app = Flask(__name__)
+for provider_id in %(providers)r:
+    app.config['SOCIAL_' + provider_id.upper()] = {
+        'consumer_key': 'xxxx', 'consumer_secret': 'xxxx'}
+state = Social().init_app(app)
+if %(load)r:
+    for provider_id in state.providers:
+        state.providers[provider_id]
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+sys.stdout.write(json.dumps(dict(elapsed=elapsed, rss=rss,
+                                 modules=len(sys.modules))))
+"""
+
+
+def run_scenario(load):
+    code = SCENARIO % dict(providers=PROVIDERS, load=load)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    return json.loads(output)
+
+
+def summarize(name, results):
+    elapsed = sorted(r['elapsed'] for r in results)[len(results) // 2]
+    rss = max(r['rss'] for r in results)
+    modules = results[0]['modules']
+    print('%-8s %10.1f ms %10d KiB %8d modules' % (name, elapsed * 1000,
+                                                   rss, modules))
+    return elapsed, rss
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('%d runs, median time and peak RSS, providers: %s' %
+          (runs, ', '.join(PROVIDERS)))
+    init = summarize('init', [run_scenario(False) for i in range(runs)])
+    loaded = summarize('loaded', [run_scenario(True) for i in range(runs)])
+    print('saved    %10.1f ms %10d KiB per worker' %
+          ((loaded[0] - init[0]) * 1000, loaded[1] - init[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,23 @@
+import os
+import socket
 import unittest
 import mock
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import after_this_request
+from flask_social.views import _commit
+from flask_social.signals import connection_created, connection_removed
+from flask_social.refresh import refresh_profiles, refresh_tokens
+from flask_social.transport import HTTPResponse
+from flask_social.writebehind import WriteBehindQueue
+from flask_social.bloom import IdentityFilter
+from flask_social.cache import KeyValueCache
+from flask_social.datastore import CachingConnectionDatastore, LOGIN_FIELDS
 from tests.test_app.sqlalchemy import create_app as create_sql_app
 from tests.test_app.mongoengine import create_app as create_mongo_app
 from tests.test_app.peewee_app import create_app as create_peewee_app
+from tests.test_app.sqlite_app import create_app as create_sqlite_app
 
 def get_mock_twitter_response():
     return {
@@ -38,6 +53,65 @@ def get_mock_twitter_updated_token_pair():
         'secret': 'the_updated_oauth_token_secret'
         }
 
+def get_mock_google_response():
+    return {
+        'access_token': 'the_access_token',
+        'refresh_token': 'the_refresh_token',
+        'expires_in': 60
+    }
+
+
+def get_mock_google_connection_values():
+    return {
+        'provider_id': 'google',
+        'provider_user_id': '4321',
+        'access_token': 'the_access_token',
+        'secret': None,
+        'display_name': 'google_name',
+        'full_name': 'google_name',
+        'profile_url': 'https://plus.google.com/4321',
+        'image_url': 'https://lh3.googleusercontent.com/photo.jpg'
+    }
+
+
+def get_mock_google_refresh_response():
+    content = '{"access_token": "the_refreshed_token", "expires_in": 3600}'
+    response = HTTPResponse(200, {'content-type': 'application/json'},
+                            content)
+    return response, content
+
+class DictCache(KeyValueCache):
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.items[key] = value
+
+    def add(self, key, value):
+        return self.items.setdefault(key, value) is value
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+
+class RecordingDB(object):
+
+    def __init__(self, db, statements):
+        self.db = db
+        self.statements = statements
+
+    def execute(self, sql, *args):
+        self.statements.append(sql)
+        return self.db.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
 class SocialTest(unittest.TestCase):
 
     SOCIAL_CONFIG = None
@@ -63,6 +137,8 @@ class SocialTest(unittest.TestCase):
             return create_mongo_app(auth_config, False)
         if app_type == 'peewee':
             return create_peewee_app(auth_config, False)
+        if app_type == 'sqlite':
+            return create_sqlite_app(auth_config, False)
 
     def _post(self, route, data=None, content_type=None, follow_redirects=True, headers=None):
         content_type = content_type or 'application/x-www-form-urlencoded'
@@ -79,6 +155,27 @@ class SocialTest(unittest.TestCase):
         data = dict(email=email, password=password, remember='y')
         return self._post(endpoint or '/login', data=data, **kwargs)
 
+    @contextmanager
+    def record_statements(self, datastore):
+        """Collect the SQL statements the connection datastore sends within
+        the block."""
+        statements = []
+        if self.APP_TYPE == 'sqlite':
+            db = RecordingDB(datastore.db, statements)
+            with mock.patch.object(type(datastore), 'db', db):
+                yield statements
+            return
+        from sqlalchemy import event
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = datastore.db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
     def assertIn(self, member, container, msg=None):
         if hasattr(unittest.TestCase, 'assertIn'):
             return unittest.TestCase.assertIn(self, member, container, msg)
@@ -257,6 +354,445 @@ class TwitterSocialTests(SocialTest):
         self.assertEqual(connection.secret,
                          get_mock_twitter_updated_token_pair()['secret'])
 
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_profile_loads_connections_once(self,
+                                            mock_authorize,
+                                            mock_handle_oauth1_response,
+                                            mock_get_connection_values,
+                                            mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        datastore = self.app.extensions['social'].datastore
+        with mock.patch.object(datastore, 'find_connections',
+                               wraps=datastore.find_connections) as m:
+            r = self._get('/profile')
+        self.assertIn('Remove Twitter Connection', r.data)
+        self.assertEqual(m.call_count, 1)
+
+    @mock.patch('flask_social.providers.twitter.get_profiles')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_refresh_profiles(self,
+                              mock_authorize,
+                              mock_handle_oauth1_response,
+                              mock_get_connection_values,
+                              mock_get_profiles):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        profile = dict(get_mock_twitter_connection_values(),
+                       full_name='new_twitter_name')
+        mock_get_profiles.return_value = {'1234': profile}
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        with self.app.app_context():
+            stats = refresh_profiles(provider_ids=['twitter'], concurrency=2)
+        self.assertEqual(stats, dict(twitter=dict(checked=1, updated=1,
+                                                  failed=0)))
+        user = self.app.get_user()
+        connection = [c for c in user.connections if c.provider_id == 'twitter'][0]
+        self.assertEqual(connection.full_name, 'new_twitter_name')
+
+    @mock.patch('flask_social.providers.twitter.profiles_batch_size', 2)
+    @mock.patch('flask_social.providers.twitter.get_profiles')
+    def test_refresh_profiles_commits_while_fetching(self, mock_get_profiles):
+        def get_profiles(connections, **kwargs):
+            return dict((c.provider_user_id,
+                         dict(full_name='name %s %s' % (c.provider_user_id,
+                                                        c.access_token)))
+                        for c in connections)
+        mock_get_profiles.side_effect = get_profiles
+
+        self.authenticate()
+        datastore = self.app.social.datastore
+        provider_user_ids = [str(i) for i in range(60, 66)]
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            for provider_user_id in provider_user_ids:
+                datastore.create_connection(
+                    user_id=user_id, provider_id='twitter',
+                    provider_user_id=provider_user_id,
+                    access_token='token%s' % provider_user_id,
+                    secret='secret')
+            datastore.commit()
+
+        with self.app.app_context():
+            stats = refresh_profiles(provider_ids=['twitter'], concurrency=2,
+                                     batch_size=1)
+        self.assertEqual(stats, dict(twitter=dict(checked=6, updated=6,
+                                                  failed=0)))
+        with self.app.app_context():
+            for provider_user_id in provider_user_ids:
+                connection = datastore.find_connection(
+                    provider_id='twitter', provider_user_id=provider_user_id)
+                self.assertEqual(connection.full_name, 'name %s token%s' % (
+                    provider_user_id, provider_user_id))
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_login_fails_fast_when_twitter_unavailable(self,
+                                                       mock_authorize,
+                                                       mock_handle_oauth1_response):
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.side_effect = socket.timeout('timed out')
+
+        for x in range(6):
+            self._post('/login/twitter')
+            r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+            self.assertIn('Twitter is currently unavailable', r.data)
+        self.assertEqual(mock_handle_oauth1_response.call_count, 5)
+
+    @mock.patch('flask_social.transport.HTTPTransport.request')
+    def test_login_fails_fast_when_twitter_token_endpoint_fails(self,
+                                                               mock_request):
+        # Flask-OAuthlib raises OAuthException for a JSON error and fails to
+        # parse an error page
+        mock_request.side_effect = [
+            HTTPResponse(503, {}, '{"errors": "Over capacity"}'),
+            HTTPResponse(503, {}, '<html>Over capacity</html>')] * 3
+
+        for x in range(6):
+            with self.client.session_transaction() as session:
+                session['Twitter_oauthtok'] = (u'token', u'secret')
+            r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+            self.assertIn('Twitter is currently unavailable', r.data)
+        self.assertEqual(mock_request.call_count, 5)
+
+        mock_request.reset_mock()
+        provider = self.app.social.twitter
+        provider.circuit_breaker = None
+        mock_request.side_effect = None
+        mock_request.return_value = HTTPResponse(401, {}, 'Unauthorized')
+        with self.client.session_transaction() as session:
+            session['Twitter_oauthtok'] = (u'token', u'secret')
+        self.assertRaises(Exception, self._get, '/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        self.assertEqual(mock_request.call_count, 1)
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_find_connections_for_users(self,
+                                        mock_authorize,
+                                        mock_handle_oauth1_response,
+                                        mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        user_id = self.app.get_user().id
+        missing_id = type(user_id)('0' * 24) if self.APP_TYPE == 'mongo' else 0
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            rv = datastore.find_connections_for_users([user_id, missing_id])
+            self.assertEqual(rv[missing_id], [])
+            self.assertEqual([c.provider_user_id for c in rv[user_id]],
+                             ['1234'])
+            rv = datastore.find_connections_for_users([user_id],
+                                                      provider_ids=['google'])
+            self.assertEqual(rv, {user_id: []})
+
+    def test_find_connections_in_chunks(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            for i in range(5):
+                datastore.create_connection(user_id=user_id,
+                                            provider_id='twitter',
+                                            provider_user_id=str(i),
+                                            access_token='token')
+            datastore.commit()
+            datastore.chunk_size = 2
+            seen = []
+            for connection in datastore.find_connections(provider_id='twitter'):
+                seen.append(connection.provider_user_id)
+                connection.display_name = 'changed'
+                datastore.put(connection)
+                datastore.commit()
+            self.assertEqual(len(seen), len(set(seen)))
+            self.assertTrue(set(['0', '1', '2', '3', '4']) <= set(seen))
+            connections = datastore.find_connections(user_id=user_id)
+            self.assertEqual(set(c.display_name for c in connections),
+                             set(['changed']))
+
+    def test_find_expiring_connections_by_expiry(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        now = datetime(2014, 1, 1)
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            for i, minutes in enumerate([3, 1, 2, 1, 9]):
+                datastore.create_connection(
+                    user_id=user_id, provider_id='google',
+                    provider_user_id=str(i), access_token='token',
+                    refresh_token='refresh',
+                    expires_at=now + timedelta(minutes=minutes))
+            datastore.commit()
+            datastore.chunk_size = 2
+            connections = datastore.find_expiring_connections(
+                now + timedelta(minutes=5), provider_id='google')
+            self.assertEqual([c.provider_user_id for c in connections],
+                             ['1', '3', '2', '0'])
+
+    def test_find_connection_fields(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            datastore.create_connection(user_id=user_id,
+                                        provider_id='twitter',
+                                        provider_user_id='42',
+                                        access_token='token',
+                                        secret='secret')
+            datastore.commit()
+            for i in range(2):
+                connection = datastore.find_connection(
+                    fields=LOGIN_FIELDS, provider_id='twitter',
+                    provider_user_id='42')
+                self.assertEqual(connection.access_token, 'token')
+                self.assertEqual(connection.secret, 'secret')
+                self.assertEqual(connection.user.id, user_id)
+            shapes = [key for key in datastore._query_shapes
+                      if key[1] == LOGIN_FIELDS]
+            self.assertEqual(len(shapes), 1)
+
+    def test_login_lookup(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            datastore.create_connection(user_id=user_id,
+                                        provider_id='twitter',
+                                        provider_user_id='44',
+                                        access_token='token',
+                                        secret='secret')
+            datastore.commit()
+            connection, user = datastore.login_lookup('twitter', '44')
+            self.assertEqual(user.id, user_id)
+            self.assertFalse(datastore.update_connection(
+                connection, access_token='token', secret='secret'))
+            self.assertTrue(datastore.update_connection(
+                connection, access_token='new_token', secret='secret'))
+            self.assertEqual(connection.access_token, 'new_token')
+            datastore.commit()
+            connection = datastore.find_connection(provider_id='twitter',
+                                                   provider_user_id='44')
+            self.assertEqual(connection.access_token, 'new_token')
+            self.assertEqual(datastore.login_lookup('twitter', '0'),
+                             (None, None))
+
+    def test_login_statements(self):
+        if self.APP_TYPE not in (None, 'sqlite'):
+            self.skipTest('Statements are counted for SQL datastores only')
+        self.authenticate()
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            datastore.create_connection(user_id=user_id,
+                                        provider_id='twitter',
+                                        provider_user_id='46',
+                                        access_token='token',
+                                        secret='secret')
+            datastore.commit()
+
+        with self.app.app_context():
+            with self.record_statements(datastore) as statements:
+                connection, user = datastore.login_lookup('twitter', '46')
+                self.assertEqual(user.id, user_id)
+                datastore.update_connection(connection,
+                                            access_token='new_token',
+                                            secret='secret')
+                datastore.commit()
+        # The SQLite datastore leaves reading the user to Flask-Security
+        self.assertEqual([s.split()[0].upper() for s in statements],
+                         ['SELECT', 'UPDATE'])
+        if self.APP_TYPE is None:
+            self.assertIn('JOIN', statements[0])
+
+    def test_write_behind_queue(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        queue = WriteBehindQueue(datastore)
+        query = dict(provider_id='twitter', provider_user_id='45')
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            datastore.create_connection(user_id=user_id, access_token='token',
+                                        secret='secret', **query)
+            datastore.commit()
+            connection = datastore.find_connection(**query)
+            self.assertTrue(queue.put(connection, access_token='first'))
+            self.assertTrue(queue.put(connection, access_token='second'))
+            self.assertFalse(queue.put(connection, access_token='second'))
+            self.assertEqual(len(queue), 1)
+        with self.app.app_context():
+            connection = datastore.find_connection(**query)
+            self.assertEqual(connection.access_token, 'token')
+            queue.apply(connection)
+            self.assertEqual(connection.access_token, 'second')
+        with self.app.app_context():
+            queue.flush()
+            self.assertEqual(len(queue), 0)
+            connection = datastore.find_connection(**query)
+            self.assertEqual(connection.access_token, 'second')
+
+    def test_caching_connection_datastore(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        caching = CachingConnectionDatastore(datastore, cache=DictCache())
+        query = dict(provider_id='twitter', provider_user_id='46')
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            with mock.patch.object(datastore, 'login_lookup',
+                                   wraps=datastore.login_lookup) as m:
+                self.assertEqual(caching.login_lookup('twitter', '46'),
+                                 (None, None))
+                self.assertEqual(caching.login_lookup('twitter', '46'),
+                                 (None, None))
+                self.assertEqual(m.call_count, 1)
+            # Created without the wrapper, which learns of it from the signal
+            connection = datastore.create_connection(
+                user_id=user_id, access_token='token', secret='secret',
+                **query)
+            datastore.commit()
+            state = self.app.extensions['social']
+            state.datastore = caching
+            try:
+                connection_created.send(self.app, user=self.app.get_user(),
+                                        connection=connection)
+            finally:
+                state.datastore = datastore
+        lookups = []
+        for token in ('token', 'login_token', 'login_token'):
+            with self.app.app_context():
+                with mock.patch.object(datastore, 'login_lookup',
+                                       wraps=datastore.login_lookup) as m:
+                    connection, user = caching.login_lookup('twitter', '46')
+                    lookups.append(m.call_count)
+                self.assertEqual(user.id, user_id)
+                self.assertEqual(connection.access_token, token)
+                caching.update_connection(connection,
+                                          access_token='login_token')
+                caching.commit()
+        # The changed token discards the cached login, the unchanged one not
+        self.assertEqual(lookups, [1, 1, 0])
+        with self.app.app_context():
+            connection, user = caching.login_lookup('twitter', '46')
+            caching.update_connection(connection, access_token='token')
+            caching.commit()
+        with self.app.app_context():
+            with mock.patch.object(datastore, 'find_connection',
+                                   wraps=datastore.find_connection) as m:
+                for i in range(2):
+                    connection = caching.find_connection(**query)
+                    self.assertEqual(connection.access_token, 'token')
+                    self.assertEqual(connection.user.id, user_id)
+                self.assertEqual(m.call_count, 1)
+            caching.update_connection(connection, access_token='new_token')
+            caching.commit()
+        with self.app.app_context():
+            connection = caching.find_connection(**query)
+            self.assertEqual(connection.access_token, 'new_token')
+            with mock.patch.object(datastore, 'find_connections',
+                                   wraps=datastore.find_connections) as m:
+                for i in range(2):
+                    connections = caching.find_connections(user_id=user_id)
+                    self.assertIn('46', [c.provider_user_id
+                                         for c in connections])
+                self.assertEqual(m.call_count, 1)
+            self.assertTrue(caching.delete_connection(**query))
+            caching.commit()
+            self.assertIsNone(caching.find_connection(**query))
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_identity_filter(self, mock_authorize, mock_handle_oauth1_response,
+                             mock_get_token_pair_from_response,
+                             mock_get_connection_values):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        clock = [0]
+        identities = IdentityFilter(datastore, 100, refresh_interval=60,
+                                    timer=lambda: clock[0])
+        self.assertTrue(identities.might_exist('twitter', '47'))
+
+        def create(provider_user_id):
+            datastore.create_connection(
+                user_id=self.app.get_user().id, provider_id='twitter',
+                provider_user_id=provider_user_id, access_token='token',
+                secret='secret')
+            datastore.commit()
+
+        with self.app.app_context():
+            create('47')
+            identities.build()
+            self.assertTrue(identities.might_exist('twitter', '47'))
+            create('48')
+            self.assertFalse(identities.might_exist('twitter', '48'))
+            clock[0] = 60
+            self.assertTrue(identities.might_exist('twitter', '48'))
+
+            snapshot = 'identities-%d.snapshot' % os.getpid()
+            try:
+                identities.save(snapshot)
+                create('49')
+                loaded = IdentityFilter(datastore, 100, snapshot=snapshot)
+                loaded.start()
+                self.assertTrue(loaded.might_exist('twitter', '48'))
+                self.assertTrue(loaded.might_exist('twitter', '49'))
+            finally:
+                os.remove(snapshot)
+        stats = identities.stats()
+        self.assertEqual(stats['checks'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertGreater(stats['bytes'], 0)
+
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        self.app.extensions['social'].identity_filter = identities
+        with mock.patch.object(datastore, 'login_lookup') as m:
+            self.client.get('/logout')
+            self._post('/login/twitter')
+            r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+            self.assertIn('Twitter account not associated with an existing user', r.data)
+            self.assertFalse(m.called)
+
+    def test_upsert_connection(self):
+        self.authenticate()
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            user_id = self.app.get_user().id
+            values = dict(user_id=user_id, provider_id='twitter',
+                          provider_user_id='43', access_token='token')
+            connection = datastore.upsert_connection(**values)
+            self.assertEqual(connection.access_token, 'token')
+            datastore.commit()
+            values['access_token'] = 'other'
+            self.assertIsNone(datastore.upsert_connection(**values))
+            connections = datastore.find_connections(provider_id='twitter',
+                                                     provider_user_id='43')
+            self.assertEqual([c.access_token for c in connections], ['token'])
+
     @mock.patch('flask_social.providers.twitter.get_connection_values')
     @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
     @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
@@ -274,9 +810,158 @@ class TwitterSocialTests(SocialTest):
         r = self.client.delete('/connect/twitter/1234', follow_redirects=True)
         self.assertIn('Connection to Twitter removed', r.data)
 
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_remove_all_connections(self,
+                                    mock_authorize,
+                                    mock_handle_oauth1_response,
+                                    mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self._post('/login', data=dict(email='matt@lp.com', password='password'))
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        removed = []
+
+        def on_removed(app, **kwargs):
+            removed.append(kwargs['connection'].provider_user_id)
+
+        with connection_removed.connected_to(on_removed):
+            r = self.client.delete('/connect/twitter', follow_redirects=True,
+                                   headers={'Referer': '/profile'})
+        self.assertIn('All connections to Twitter removed', r.data)
+        self.assertEqual(removed, ['1234'])
+        user = self.app.get_user()
+        self.assertEqual([c for c in user.connections
+                          if c.provider_id == 'twitter'], [])
+
+
+class GoogleSocialTests(SocialTest):
+
+    def _connect_google(self):
+        self.authenticate()
+        self._post('/connect/google')
+        return self._get('/connect/google?code=code', follow_redirects=True)
+
+    def _get_google_connection(self):
+        user = self.app.get_user()
+        return [c for c in user.connections if c.provider_id == 'google'][0]
+
+    @mock.patch('flask_social.core.OAuthRemoteApp.http_request')
+    @mock.patch('flask_social.providers.google.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth2_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_reconnect_refreshes_token(self,
+                                       mock_authorize,
+                                       mock_handle_oauth2_response,
+                                       mock_get_connection_values,
+                                       mock_http_request):
+        mock_get_connection_values.return_value = get_mock_google_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth2_response.return_value = get_mock_google_response()
+        mock_http_request.return_value = get_mock_google_refresh_response()
+
+        r = self._connect_google()
+        self.assertIn('Connection established to Google', r.data)
+        connection = self._get_google_connection()
+        self.assertEqual(connection.refresh_token, 'the_refresh_token')
+        expires_at = connection.expires_at
+
+        r = self._post('/reconnect/google', headers={'Referer': '/profile'})
+        self.assertIn('Connection to Google refreshed', r.data)
+        self.assertEqual(mock_authorize.call_count, 1)
+        connection = self._get_google_connection()
+        self.assertEqual(connection.access_token, 'the_refreshed_token')
+        self.assertEqual(connection.refresh_token, 'the_refresh_token')
+        self.assertTrue(connection.expires_at > expires_at)
+
+    @mock.patch('flask_social.core.OAuthRemoteApp.http_request')
+    @mock.patch('flask_social.providers.google.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth2_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_refresh_tokens(self,
+                            mock_authorize,
+                            mock_handle_oauth2_response,
+                            mock_get_connection_values,
+                            mock_http_request):
+        mock_get_connection_values.return_value = get_mock_google_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth2_response.return_value = get_mock_google_response()
+        mock_http_request.return_value = get_mock_google_refresh_response()
+
+        self._connect_google()
+        with self.app.app_context():
+            # Connections without a refresh token are not loaded
+            datastore = self.app.social.datastore
+            datastore.create_connection(
+                user_id=self.app.get_user().id, provider_id='google',
+                provider_user_id='4322', access_token='token',
+                expires_at=datetime.utcnow())
+            datastore.commit()
+
+        with self.app.app_context():
+            stats = refresh_tokens(provider_ids=['google'], within=30)
+            self.assertEqual(stats['google']['expiring'], 0)
+            stats = refresh_tokens(provider_ids=['google'])
+        self.assertEqual(stats, dict(google=dict(expiring=1, refreshed=1,
+                                                 failed=0)))
+        self.assertEqual(self._get_google_connection().access_token,
+                         'the_refreshed_token')
+
+    @mock.patch('flask_social.core.after_this_request')
+    @mock.patch('flask_social.providers.google.get_api')
+    @mock.patch('flask_social.core.OAuthRemoteApp.http_request')
+    @mock.patch('flask_social.providers.google.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth2_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_get_api_commits_refreshed_token_after_request(
+            self, mock_authorize, mock_handle_oauth2_response,
+            mock_get_connection_values, mock_http_request, mock_get_api,
+            mock_after_this_request):
+        mock_get_connection_values.return_value = get_mock_google_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth2_response.return_value = get_mock_google_response()
+        mock_http_request.return_value = get_mock_google_refresh_response()
+        mock_after_this_request.side_effect = after_this_request
+
+        self._connect_google()
+        datastore = self.app.social.datastore
+        with mock.patch.object(datastore, 'commit',
+                               wraps=datastore.commit) as mock_commit:
+            r = self._get('/api/google')
+            self.assertEqual(r.data, 'OK')
+        mock_after_this_request.assert_called_once_with(_commit)
+        self.assertEqual(mock_commit.call_count, 1)
+        self.assertEqual(self._get_google_connection().access_token,
+                         'the_refreshed_token')
+
 
 class MongoEngineTwitterSocialTests(TwitterSocialTests):
     APP_TYPE = 'mongo'
 
+    def test_identity_filter(self):
+        # ObjectIds of other processes are not ordered by creation
+        self.assertRaises(ValueError, IdentityFilter,
+                          self.app.social.datastore, 100)
+
 class PeeweeTwitterSocialTests(TwitterSocialTests):
     APP_TYPE = 'peewee'
+
+class SQLiteTwitterSocialTests(TwitterSocialTests):
+    APP_TYPE = 'sqlite'
+
+
+class MongoEngineGoogleSocialTests(GoogleSocialTests):
+    APP_TYPE = 'mongo'
+
+
+class PeeweeGoogleSocialTests(GoogleSocialTests):
+    APP_TYPE = 'peewee'
+
+
+class SQLiteGoogleSocialTests(GoogleSocialTests):
+    APP_TYPE = 'sqlite'
@@ -97,4 +97,10 @@ def create_app(config, debug=True):
             facebook_conn=current_app.social.facebook.get_connection(),
             foursquare_conn=current_app.social.foursquare.get_connection())
 
+    @app.route('/api/<provider_id>')
+    @login_required
+    def api(provider_id):
+        getattr(current_app.social, provider_id).get_api()
+        return 'OK'
+
     return app
@@ -10,6 +10,7 @@ from flask.ext.mongoengine import MongoEngine
 from flask.ext.security import Security, UserMixin, RoleMixin, \
      MongoEngineUserDatastore
 from flask.ext.social import Social, MongoEngineConnectionDatastore
+from flask.ext.social.models import MongoEngineConnectionMixin
 
 from tests.test_app import create_app as create_base_app, populate_data
 
@@ -38,17 +39,8 @@ def create_app(auth_config=None, debug=True):
         def connections(self):
             return Connection.objects(user_id=str(self.id))
 
-    class Connection(db.Document):
+    class Connection(db.Document, MongoEngineConnectionMixin):
         user_id = db.ObjectIdField()
-        provider_id = db.StringField(max_length=255)
-        provider_user_id = db.StringField(max_length=255)
-        access_token = db.StringField(max_length=255)
-        secret = db.StringField(max_length=255)
-        display_name = db.StringField(max_length=255)
-        full_name = db.StringField(max_length=255)
-        profile_url = db.StringField(max_length=512)
-        image_url = db.StringField(max_length=512)
-        rank = db.IntField(default=1)
 
         @property
         def user(self):
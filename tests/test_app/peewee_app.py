@@ -10,6 +10,7 @@ from flask_peewee.db import Database
 from flask.ext.security import Security, UserMixin, RoleMixin, \
     PeeweeUserDatastore
 from flask.ext.social import Social, PeeweeConnectionDatastore
+from flask.ext.social.models import PeeweeConnectionMixin
 from peewee import *
 
 from tests.test_app import create_app as create_base_app, populate_data
@@ -47,17 +48,11 @@ def create_app(config=None, debug=True):
         name = property(lambda self: self.role.name)
         description = property(lambda self: self.role.description)
 
-    class Connection(db.Model):
+    class Connection(db.Model, PeeweeConnectionMixin):
         user = ForeignKeyField(User, related_name='connections')
-        provider_id = TextField()
-        provider_user_id = TextField()
-        access_token = TextField()
-        secret = TextField(null=True)
-        display_name = TextField()
-        full_name = TextField()
-        profile_url = TextField()
-        image_url = TextField()
-        rank = IntegerField(null=True)
+
+        class Meta:
+            indexes = PeeweeConnectionMixin._meta.indexes
 
     app.security = Security(app, PeeweeUserDatastore(db, User, Role, UserRoles))
     app.social = Social(app, PeeweeConnectionDatastore(db, Connection))
@@ -9,6 +9,7 @@ sys.path.insert(0, os.getcwd())
 from flask.ext.security import Security, UserMixin, RoleMixin, \
      SQLAlchemyUserDatastore
 from flask.ext.social import Social, SQLAlchemyConnectionDatastore
+from flask.ext.social.models import SQLAlchemyConnectionMixin
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from tests.test_app import create_app as create_base_app, populate_data
@@ -39,18 +40,9 @@ def create_app(config=None, debug=True):
         connections = db.relationship('Connection',
                     backref=db.backref('user', lazy='joined'))
 
-    class Connection(db.Model):
+    class Connection(db.Model, SQLAlchemyConnectionMixin):
         id = db.Column(db.Integer, primary_key=True)
         user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-        provider_id = db.Column(db.String(255))
-        provider_user_id = db.Column(db.String(255))
-        access_token = db.Column(db.String(255))
-        secret = db.Column(db.String(255))
-        display_name = db.Column(db.String(255))
-        full_name = db.Column(db.String(255))
-        profile_url = db.Column(db.String(512))
-        image_url = db.Column(db.String(512))
-        rank = db.Column(db.Integer)
 
     app.security = Security(app, SQLAlchemyUserDatastore(db, User, Role))
     app.social = Social(app, SQLAlchemyConnectionDatastore(db, Connection))
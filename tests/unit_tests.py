@@ -1,5 +1,52 @@
+import base64
+import json
+import socket
+import threading
+import time
+import types
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+
+import mock
+
+from flask import Flask
 from unittest import TestCase
-from flask_social.core import _SocialState
+from flask_social.bloom import BloomFilter, IdentityFilter
+from flask_social.cache import LRUCache
+from flask_social.circuit import CircuitBreaker
+from flask_social.core import Social, _SocialState, _ProviderRegistry
+from flask_social.datastore import CachingConnectionDatastore, \
+    ConnectionDatastore, PeeweeConnectionDatastore, \
+    SQLAlchemyConnectionDatastore
+from flask_social.models import SQLAlchemyConnectionMixin
+from flask_social.providers import ModuleProviderAdapter, cached_profile, \
+     profile_cache
+from flask_social.ratelimit import RateLimitedAPI, RateLimitExceeded, \
+    TokenBucket, parse_rate_limit_headers
+from flask_social.signals import connection_removed
+from flask_social.transport import HTTPTransport, HTTPResponse, \
+    request_policy
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps(dict(path=self.path))
+        failures = getattr(self.server, 'failures', 0)
+        self.server.failures = max(failures - 1, 0)
+        self.send_response(503 if failures else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        remaining = getattr(self.server, 'remaining', None)
+        if remaining is not None:
+            self.send_header('X-Rate-Limit-Remaining', str(remaining))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class FlaskSocialUnitTests(TestCase):
@@ -7,3 +54,435 @@ class FlaskSocialUnitTests(TestCase):
     def test_social_state_raises_attribute_error(self):
         state = _SocialState(providers={})
         self.assertRaises(AttributeError, lambda: state.something)
+
+    def test_init_app_without_datastore_indexes(self):
+        for datastore in (None, object()):
+            app = Flask(__name__)
+            state = Social(datastore=datastore).init_app(app)
+            self.assertIs(app.extensions['social'], state)
+
+    def test_provider_registry_loads_lazily(self):
+        providers = _ProviderRegistry()
+        providers.register('missing', 'flask_social.providers.missing', {})
+        self.assertEqual(list(providers), ['missing'])
+        self.assertFalse(providers.is_loaded('missing'))
+        self.assertRaises(ImportError, lambda: providers['missing'])
+        self.assertRaises(KeyError, lambda: providers['other'])
+
+    def test_module_adapter_requires_provider_functions(self):
+        module = types.ModuleType('flask_social.providers.incomplete')
+        module.get_api = lambda connection, **kwargs: None
+        module.get_provider_user_id = lambda response, **kwargs: None
+        module.get_connection_values = lambda response, **kwargs: None
+        module.get_token_pair_from_reponse = lambda response: None
+        self.assertRaises(ImportError, ModuleProviderAdapter, None, module)
+        module.get_token_pair_from_response = lambda response: None
+        self.assertTrue(ModuleProviderAdapter(None, module).module is module)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_lru_cache_expires_items(self):
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set('a', 1)
+        now[0] = 9
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 10
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+        cache.set('b', 2, timeout=1)
+        now[0] = 11
+        self.assertEqual(cache.get('b'), None)
+
+    def test_lru_cache_discard_if(self):
+        cache = LRUCache(maxsize=10)
+        cache.set(('twitter', '1', 'x'), 1)
+        cache.set(('twitter', '2', 'x'), 2)
+        self.assertEqual(cache.discard_if(lambda k: k[1] == '1'), 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_linkedin_api_token_expiry_from_expires_at(self):
+        from flask_social.providers import linkedin
+        expires_at = datetime.utcnow() + timedelta(seconds=100)
+        connection = mock.Mock(spec=['access_token', 'expires_at'],
+                               access_token='token', expires_at=expires_at)
+        api = linkedin.get_api(connection, consumer_key='key',
+                               consumer_secret='secret')
+        self.assertEqual(api.authentication.token.access_token, 'token')
+        self.assertIn(api.authentication.token.expires_in, (99, 100))
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('known-%d' % i)
+        self.assertTrue(all('known-%d' % i in bloom for i in range(1000)))
+        false_positives = sum('unknown-%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertGreater(len(bloom), 990)
+        self.assertLess(bloom.memory_usage, 1300)
+        self.assertAlmostEqual(bloom.estimated_error_rate, 0.01, places=2)
+
+    @mock.patch('flask_social.providers.google.get_transport')
+    def test_google_discovery_document_is_fetched_once(self, mock_transport):
+        from flask_social.providers import google
+        google._discovery.clear()
+        document = dict(rootUrl='https://www.googleapis.com/',
+                        servicePath='oauth2/v2/', resources={}, schemas={})
+        mock_request = mock_transport.return_value.request
+        mock_request.return_value = HTTPResponse(200, {}, json.dumps(document))
+
+        for x in range(2):
+            self.assertEqual(google._get_discovery()[0], document)
+        self.assertEqual(mock_request.call_count, 1)
+        google._discovery.clear()
+
+    def test_transport_reuses_connections(self):
+        server = HTTPServer(('127.0.0.1', 0), _JSONHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            transport = HTTPTransport(pool_size=1, timeout=5)
+            url = 'http://127.0.0.1:%s/me' % server.server_port
+            for x in range(3):
+                rv = transport.get_json(url, dict(access_token='x'))
+                self.assertEqual(rv['path'], '/me?access_token=x')
+            stats = transport.stats()
+            self.assertEqual(stats['requests'], 3)
+            self.assertEqual(stats['connections'], 1)
+            self.assertEqual(stats['reused'], 2)
+            transport.close()
+        finally:
+            server.shutdown()
+
+    def test_cached_profile_fetches_once_per_token(self):
+        calls = []
+
+        @cached_profile('test')
+        def get_profile(access_token):
+            calls.append(access_token)
+            return dict(id=access_token)
+
+        for token in ('a', 'a', 'b'):
+            self.assertEqual(get_profile(token), dict(id=token))
+        self.assertEqual(calls, ['a', 'b'])
+        profile_cache.clear()
+
+    @mock.patch('flask_social.providers.google.googlecrypt')
+    @mock.patch('flask_social.providers.google.get_transport')
+    def test_google_id_token_verified_with_cached_certs(self, mock_transport,
+                                                        mock_crypt):
+        from flask_social.providers import google
+        certs = dict(key1='pem1', key2='pem2')
+        mock_transport.return_value.request.return_value = HTTPResponse(
+            200, {'cache-control': 'public, max-age=600'}, json.dumps(certs))
+        mock_crypt.verify_signed_jwt_with_certs.return_value = dict(
+            iss='accounts.google.com', sub='1234')
+        header = json.dumps(dict(alg='RS256', kid='key1'))
+        id_token = '%s.payload.signature' % base64.urlsafe_b64encode(header)
+
+        for x in range(2):
+            payload = google.verify_id_token(id_token, 'client-id')
+            self.assertEqual(payload['sub'], '1234')
+        self.assertEqual(mock_transport.return_value.request.call_count, 1)
+        mock_crypt.verify_signed_jwt_with_certs.assert_called_with(
+            id_token, dict(key1='pem1'), 'client-id')
+        google._certs.update(certs={}, fetched=0, expires=0)
+
+    def test_token_bucket_waits_or_fails_fast(self):
+        now = [0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        bucket = TokenBucket(2, 10, timer=lambda: now[0], sleep=sleep)
+        self.assertEqual(bucket.acquire(0), 0)
+        self.assertEqual(bucket.acquire(0), 0)
+        self.assertEqual(bucket.acquire(0), 5)
+        self.assertEqual(bucket.acquire(1), 5)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(now[0], 5)
+        self.assertEqual(bucket.quota()['remaining'], 0)
+
+    def test_token_bucket_follows_provider_headers(self):
+        now = [100]
+        bucket = TokenBucket(180, 900, timer=lambda: now[0])
+        headers = {'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '160'}
+        bucket.update(*parse_rate_limit_headers(headers, 180))
+        self.assertEqual(bucket.try_acquire(), 60)
+        now[0] = 160
+        self.assertEqual(bucket.try_acquire(), 0)
+        usage = {'x-app-usage': '{"call_count": 75, "total_time": 10}'}
+        self.assertEqual(parse_rate_limit_headers(usage, 200), (50, None))
+        self.assertEqual(parse_rate_limit_headers({}, 200), None)
+
+    def test_rate_limited_api_takes_a_token_per_call(self):
+        api = mock.Mock(name_attr='value')
+        bucket = TokenBucket(1, 60)
+        limited = RateLimitedAPI(api, 'twitter', bucket, timeout=0)
+        self.assertEqual(limited.name_attr, 'value')
+        limited.PostUpdate('hello')
+        api.PostUpdate.assert_called_with('hello')
+        self.assertRaises(RateLimitExceeded, limited.PostUpdate, 'again')
+        self.assertEqual(api.PostUpdate.call_count, 1)
+
+    @mock.patch('twitter.Api.GetHelpConfiguration', return_value={})
+    def test_provider_clients_pass_responses_to_hook(self, mock_config):
+        from flask_social.providers import linkedin, twitter
+        server = HTTPServer(('127.0.0.1', 0), _JSONHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%s/me' % server.server_port
+        connection = mock.Mock(access_token='token', secret='secret',
+                               expires_at=None)
+        try:
+            responses = []
+            kwargs = dict(consumer_key='key', consumer_secret='secret',
+                          response_hook=responses.append)
+            server.remaining = 5
+            twitter.get_api(connection, **kwargs)._RequestUrl(url, 'GET')
+            server.remaining = 2
+            linkedin.get_api(connection, **kwargs).make_request('GET', url)
+            self.assertEqual([r.status for r in responses], [200, 200])
+            self.assertEqual([parse_rate_limit_headers(r.headers, 10)
+                              for r in responses], [(5, None), (2, None)])
+            # Without a hook the clients do not report responses
+            del kwargs['response_hook']
+            twitter.get_api(connection, **kwargs)._RequestUrl(url, 'GET')
+            self.assertEqual(len(responses), 2)
+        finally:
+            server.shutdown()
+
+    def test_transport_retries_idempotent_requests(self):
+        server = HTTPServer(('127.0.0.1', 0), _JSONHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            transport = HTTPTransport(timeout=5)
+            url = 'http://127.0.0.1:%s/me' % server.server_port
+            server.failures = 1
+            self.assertEqual(transport.request(url).status, 503)
+            server.failures = 1
+            with request_policy(timeout=5, retries=2, backoff=0):
+                self.assertEqual(transport.request(url).status, 200)
+                server.failures = 3
+                self.assertEqual(transport.request(url).status, 503)
+            self.assertEqual(transport.stats()['retries'], 3)
+            transport.close()
+        finally:
+            server.shutdown()
+
+    def test_transport_sends_requests_through_proxy(self):
+        server = HTTPServer(('127.0.0.1', 0), _JSONHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            transport = HTTPTransport(timeout=5, proxies=dict(
+                http='http://127.0.0.1:%s' % server.server_port))
+            rv = transport.get_json('http://api.example.com/me',
+                                    dict(access_token='x'))
+            self.assertEqual(rv['path'],
+                             'http://api.example.com/me?access_token=x')
+            transport.close()
+        finally:
+            server.shutdown()
+
+    def test_transport_resends_only_idempotent_requests(self):
+        server = HTTPServer(('127.0.0.1', 0), _JSONHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            transport = HTTPTransport(timeout=5, proxies={})
+            url = 'http://127.0.0.1:%s/me' % server.server_port
+            key = ('http', '127.0.0.1', server.server_port, None)
+            closed = mock.Mock(sock=None)
+            closed.request.side_effect = socket.error('Connection reset')
+            transport._pools[key] = [closed]
+            self.assertRaises(socket.error, transport.request, url,
+                              method='POST', body='')
+            self.assertEqual(transport.stats()['connections'], 0)
+            transport._pools[key] = [closed]
+            self.assertEqual(transport.request(url).status, 200)
+            self.assertEqual(transport.stats()['connections'], 1)
+            transport.close()
+        finally:
+            server.shutdown()
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30,
+                                 timer=lambda: now[0])
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        now[0] = 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        now[0] = 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_missing_connection_indexes(self):
+        from sqlalchemy import Column, ForeignKey, Integer, String
+        from sqlalchemy.ext.declarative import declarative_base
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = 'user'
+            id = Column(Integer, primary_key=True)
+
+        class Connection(Base, SQLAlchemyConnectionMixin):
+            __tablename__ = 'connection'
+            id = Column(Integer, primary_key=True)
+            user_id = Column(Integer, ForeignKey('user.id'))
+
+        class BareConnection(Base):
+            __tablename__ = 'bare_connection'
+            id = Column(Integer, primary_key=True)
+            user_id = Column(Integer, ForeignKey('user.id'), index=True)
+            provider_id = Column(String(255))
+            provider_user_id = Column(String(255))
+
+        datastore = SQLAlchemyConnectionDatastore(None, Connection)
+        self.assertEqual(datastore.missing_indexes(), [])
+        datastore = SQLAlchemyConnectionDatastore(None, BareConnection)
+        self.assertEqual(datastore.missing_indexes(),
+                         [('provider_user_id', 'provider_id')])
+
+    def test_connection_mixins_declare_indexes(self):
+        import mongoengine
+        import peewee
+        from flask_social.models import MongoEngineConnectionMixin, \
+            PeeweeConnectionMixin
+
+        class Document(mongoengine.Document, MongoEngineConnectionMixin):
+            user_id = mongoengine.ObjectIdField()
+
+        specs = [spec['fields'] for spec in Document._meta['index_specs']]
+        self.assertEqual(specs, [[('provider_id', 1), ('provider_user_id', 1)],
+                                 [('user_id', 1), ('provider_id', 1)]])
+
+        class Model(peewee.Model):
+            pass
+
+        class User(Model):
+            pass
+
+        class Connection(Model, PeeweeConnectionMixin):
+            user = peewee.ForeignKeyField(User)
+
+            class Meta:
+                indexes = PeeweeConnectionMixin._meta.indexes
+
+        datastore = PeeweeConnectionDatastore(None, Connection)
+        self.assertEqual(datastore.missing_indexes(), [])
+
+    def test_caching_datastore_loads_concurrent_misses_once(self):
+        calls = []
+
+        class Datastore(ConnectionDatastore):
+            def find_connection(self, fields=None, **kwargs):
+                calls.append(kwargs)
+                time.sleep(0.05)
+                return None
+
+        datastore = CachingConnectionDatastore(Datastore(None))
+        query = dict(provider_id='twitter', provider_user_id='1234')
+        threads = [threading.Thread(target=datastore.find_connection,
+                                    kwargs=query) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(datastore.find_connection(**query))
+        self.assertEqual(len(calls), 1)
+        datastore.invalidate()
+        datastore.find_connection(**query)
+        self.assertEqual(len(calls), 2)
+
+    def test_caching_datastore_caches_missing_logins_briefly(self):
+        calls = []
+
+        class Datastore(ConnectionDatastore):
+            def login_lookup(self, provider_id, provider_user_id):
+                calls.append(provider_user_id)
+                return None, None
+
+        now = [0]
+        cache = LRUCache(100, 300, timer=lambda: now[0])
+        datastore = CachingConnectionDatastore(Datastore(None), cache=cache,
+                                               negative_timeout=5)
+        for i in range(2):
+            self.assertEqual(datastore.login_lookup('twitter', '1234'),
+                             (None, None))
+        self.assertEqual(len(calls), 1)
+        now[0] = 5
+        datastore.login_lookup('twitter', '1234')
+        self.assertEqual(len(calls), 2)
+        datastore.negative_timeout = 0
+        now[0] = 10
+        datastore.login_lookup('twitter', '1234')
+        datastore.login_lookup('twitter', '1234')
+        self.assertEqual(len(calls), 4)
+
+    def test_caching_datastore_and_identity_filter_ignore_removals(self):
+        receivers = len(connection_removed.receivers)
+        datastore = ConnectionDatastore(None)
+        datastore._has_sequential_pk = lambda: True
+        identities = IdentityFilter(CachingConnectionDatastore(datastore), 100)
+        self.assertEqual(len(connection_removed.receivers), receivers)
+        identities.record_removed(2)
+        self.assertEqual(identities.stats()['removed'], 2)
+
+    def test_identity_filter_reads_out_of_order_commits(self):
+        rows = {}
+
+        class Datastore(ConnectionDatastore):
+            chunk_size = 2
+
+            def _has_sequential_pk(self):
+                return True
+
+            def _find_connections_chunk(self, after, limit, fields=None):
+                pks = sorted(pk for pk in rows if after is None or pk > after)
+                return [rows[pk] for pk in pks[:limit]]
+
+        def commit(pk):
+            rows[pk] = mock.Mock(id=pk, provider_id='twitter',
+                                 provider_user_id=str(pk))
+
+        for pk in (1, 2, 4, 5, 6):
+            commit(pk)
+        identities = IdentityFilter(Datastore(None), 100, refresh_interval=0,
+                                    overlap=3)
+        identities.build()
+        # 3 and 7 commit after 4 to 6 were read
+        commit(3)
+        commit(7)
+        self.assertTrue(identities.might_exist('twitter', '7'))
+        self.assertTrue(identities.might_exist('twitter', '3'))
+        # The next read starts after 4, reading the last 3 connections again
+        self.assertEqual(identities._recent, [4, 5, 6, 7])
+
+        # Keys of new connections might be smaller than the keys read
+        self.assertRaises(ValueError, IdentityFilter, ConnectionDatastore(None),
+                          100)